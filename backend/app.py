@@ -1,31 +1,115 @@
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
+import shutil
 import tempfile
-from converter import YouTubeAudioConverter
+from converter import YouTubeAudioConverter, ConversionCancelled, NOT_FASTSTART_MESSAGE
+from scheduler import JobScheduler, ScheduledJob
+from journal import JobJournal
+from jobqueue import SQLiteJobQueue
+from task_store import LocalTaskStore
+from pipeline import run_conversion
+from retention import RESULT_RETENTION_SECONDS, RETENTION_CHECK_INTERVAL, remove_result_files, purge_work_files
+from upload import UploadStream, UploadTooLarge
+from waveform import WaveformAnalyzer
 import traceback
 import threading
 import uuid
 import time
 
 app = Flask(__name__)
+
+# Proxy davanti all'app (Render, Railway, Heroku, nginx...): con TRUSTED_PROXY_HOPS > 0
+# request.remote_addr è l'IP aggiunto dall'ultimo proxy fidato, non quello dichiarato dal client
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 # Configure CORS to allow requests from any origin (for production)
 CORS(app, resources={
     r"/*": {
         "origins": "*",
-        "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"]
+        "methods": ["GET", "POST", "DELETE", "OPTIONS"],
+        "allow_headers": ["Content-Type", "Authorization", "X-API-Key"]
     }
 })
 
-# Directory per file temporanei
-TEMP_DIR = tempfile.gettempdir()
+# Directory per file temporanei (WORK_DIR su un volume persistente permette di riprendere i job dopo un riavvio)
+TEMP_DIR = os.environ.get('WORK_DIR') or tempfile.gettempdir()
 converter = YouTubeAudioConverter(TEMP_DIR)
 
-# Dizionario per tracciare lo stato delle conversioni
-# Usa un lock per thread-safety
-conversion_status = {}
-conversion_status_lock = threading.Lock()
+# Directory dei file finali servita da /download (condivisa con i worker se separati)
+OUTPUT_DIR = os.environ.get('OUTPUT_DIR') or TEMP_DIR
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+# Coda condivisa su SQLite: se configurata, questo processo fa solo da API
+# e le conversioni vengono eseguite da worker separati (python -m worker)
+JOB_QUEUE_DB = os.environ.get('JOB_QUEUE_DB')
+
+if JOB_QUEUE_DB:
+    job_queue = SQLiteJobQueue(JOB_QUEUE_DB)
+    # Stato dei task nel database condiviso, aggiornato dai worker
+    conversion_status = job_queue
+    journal = None
+    # Solo il probe dei metadati gira qui, i job ammessi vanno nella coda condivisa
+    scheduler = JobScheduler(
+        workers=0,
+        dispatch=lambda job: job_queue.enqueue(job.task_id, job.client_id, job.payload, job.cost)
+    )
+else:
+    job_queue = None
+    # Stato dei task in memoria
+    conversion_status = LocalTaskStore()
+    # Journal durevole dei job: i task non terminati vengono rimessi in coda all'avvio
+    journal = JobJournal(os.environ.get('JOB_JOURNAL') or os.path.join(TEMP_DIR, 'ytconverter-jobs.journal'))
+    # Scheduler dei job: probe dei metadati, poi shortest-job-first con aging e fair queuing per client
+    scheduler = JobScheduler(workers=int(os.environ.get('MAX_CONCURRENT_JOBS', converter.cpu_budget.total)))
+
+# Eventi di annullamento per task (condivisi con download, ffmpeg e analisi)
+cancel_events = {}
+
+# Info yt-dlp del probe, riusate dal download dello stesso task (solo coda locale:
+# il download avviene in un altro processo, che ripete l'estrazione)
+probed_infos = {}
+
+# Secondi senza polling di /status dopo i quali un task viene considerato abbandonato
+TASK_ABANDON_TIMEOUT = int(os.environ.get('TASK_ABANDON_TIMEOUT', 120))
+
+# Stati in cui un task occupa (o sta per occupare) capacità
+ACTIVE_STATUSES = ('pending', 'queued', 'downloading')
+
+# API key riconosciute per il fair queuing (separate da virgola); le altre vengono ignorate
+API_KEYS = frozenset(key.strip() for key in os.environ.get('API_KEYS', '').split(',') if key.strip())
+
+# Formati audio supportati in output
+VALID_FORMATS = ['mp3', 'wav', 'flac', 'ogg', 'm4a', 'opus']
+
+# Dimensione massima di un upload su /convert/upload (default 500 MB)
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 500 * 1024 * 1024))
+
+# Cache dei file .peaks lato client/CDN (immutabili una volta calcolati, default 1 anno)
+PEAKS_MAX_AGE = int(os.environ.get('PEAKS_MAX_AGE', 365 * 24 * 3600))
+
+# Gli upload non passano dallo scheduler: limiti propri sugli upload in corso,
+# in totale e per client (IP o API key, come il fair queuing dei job)
+MAX_CONCURRENT_UPLOADS = int(os.environ.get('MAX_CONCURRENT_UPLOADS', converter.cpu_budget.total))
+MAX_UPLOADS_PER_CLIENT = int(os.environ.get('MAX_UPLOADS_PER_CLIENT', 1))
+
+# Metriche cumulative degli upload (throughput) e upload in corso per client
+upload_stats = {'uploads': 0, 'failed': 0, 'bytes': 0, 'seconds': 0.0}
+uploads_in_progress = {}
+upload_stats_lock = threading.Lock()
+
+
+def record(task_id, event, **fields):
+    """Registra un evento nel journal (solo con coda locale: la coda condivisa è già durevole)"""
+    if journal is not None:
+        journal.append(task_id, event, **fields)
+
+
+def get_cancel_event(task_id):
+    """Evento di annullamento del task (creato se manca, es. task ripristinato)"""
+    return cancel_events.setdefault(task_id, threading.Event())
 
 
 @app.route('/')
@@ -37,118 +121,185 @@ def index():
         "endpoints": {
             "health": "/health",
             "convert": "/convert",
+            "upload": "/convert/upload",
             "status": "/status/<task_id>",
-            "download": "/download/<task_id>"
+            "download": "/download/<task_id>",
+            "peaks": "/peaks/<task_id>",
+            "cancel": "DELETE /task/<task_id>"
         }
     })
 
 
-def convert_task(task_id, youtube_url, audio_format):
-    """Esegue la conversione in un thread separato"""
+def get_client_id():
+    """
+    Identifica il client per il fair queuing: API key se configurata, altrimenti IP.
+    
+    Solo valori che il client non può inventare: le API key devono essere in API_KEYS
+    e l'IP è quello visto dal proxy fidato (TRUSTED_PROXY_HOPS), non X-Forwarded-For grezzo.
+    """
+    api_key = request.headers.get('X-API-Key')
+    if api_key and api_key in API_KEYS:
+        return f"key:{api_key}"
+    return f"ip:{request.remote_addr}"
+
+
+def probe_task(task_id, youtube_url):
+    """Step di metadati (senza download) usato dallo scheduler per stimare il costo del job"""
+    cancel_event = get_cancel_event(task_id)
+    if cancel_event.is_set():
+        raise ConversionCancelled("Conversion cancelled")
+    conversion_status.update(task_id, status='pending', progress=5, message='Fetching video info...')
+    _, info = converter.download_video(youtube_url, get_info_only=True, cancel_event=cancel_event)
+    if cancel_event.is_set():
+        raise ConversionCancelled("Conversion cancelled")
+    if job_queue is None:
+        probed_infos[task_id] = info
+    else:
+        # Il job passa alla coda condivisa: da qui in poi l'annullamento passa da request_cancel
+        cancel_events.pop(task_id, None)
+    conversion_status.update(task_id, status='queued', message='Waiting in queue...',
+                             duration=info.get('duration'))
+    record(task_id, 'queued', duration=info.get('duration'), cost=scheduler.estimate_cost(info))
+    return info
+
+
+def reject_task(task_id, error):
+    """Segna come fallito un task rifiutato in fase di ammissione"""
+    probed_infos.pop(task_id, None)
+    cancel_events.pop(task_id, None)
+    if isinstance(error, ConversionCancelled):
+        return
+    error_msg = str(error)
+    print(f"Task {task_id} rejected: {error_msg}")
+    record(task_id, 'error', error=error_msg)
+    conversion_status.update(task_id, status='error', progress=0, message='Error during conversion',
+                             error=error_msg, file=None)
+
+
+def cancel_task(task_id, reason):
+    """
+    Annulla un task: lo toglie dalla coda se non è ancora partito, altrimenti
+    segnala al worker di interrompere download, ffmpeg e analisi.
+    
+    Returns:
+        bool: True se il task esisteva ed era ancora annullabile
+    """
+    status = conversion_status.get(task_id)
+    if status is None or status['status'] in ('completed', 'error', 'cancelled'):
+        return False
+    get_cancel_event(task_id).set()
+    probed_infos.pop(task_id, None)
+    fields = {'status': 'cancelled', 'message': f'Conversion cancelled ({reason})'}
+    if job_queue is not None:
+        # Stato e richiesta di annullamento insieme: il worker se ne accorge entro WORKER_CANCEL_POLL_INTERVAL
+        job_queue.request_cancel(task_id, **fields)
+        cancel_events.pop(task_id, None)
+    else:
+        conversion_status.update(task_id, **fields)
+        if scheduler.cancel(task_id):
+            # Tolto dalla coda prima di partire: convert_task non girerà per questo task
+            cancel_events.pop(task_id, None)
+    record(task_id, 'cancelled', reason=reason)
+    print(f"Task {task_id} cancelled: {reason}")
+    return True
+
+
+def watch_abandoned_tasks():
+    """
+    Annulla i task per cui nessuno fa più polling di /status (tab chiusa).
+    
+    I task ripristinati dopo un riavvio (last_poll None) restano esclusi fino al primo
+    polling: i client si ricollegano solo quando il server torna raggiungibile.
+    """
+    while True:
+        time.sleep(max(1, TASK_ABANDON_TIMEOUT // 4))
+        now = time.time()
+        for task_id, status in conversion_status.active(ACTIVE_STATUSES):
+            last_poll = status.get('last_poll')
+            if last_poll is not None and now - last_poll > TASK_ABANDON_TIMEOUT:
+                cancel_task(task_id, 'no status polls')
+
+
+def purge_expired_results():
+    """
+    Applica la retention (RESULT_RETENTION_HOURS) a risultati e file di lavoro.
+    
+    - task terminati da più della retention: file audio e .peaks rimossi, task tolto
+      dal journal (o dalla coda condivisa) e dallo stato di /status
+    - file job-* / upload-* più vecchi della retention e non di task ancora attivi
+      (es. residui di un processo terminato a metà job)
+    """
+    before = time.time() - RESULT_RETENTION_SECONDS
+    if job_queue is not None:
+        # I file di lavoro stanno nei worker, che li puliscono da soli
+        expired = job_queue.expire(before)
+    else:
+        expired = journal.expire(before)
+        for task_id in expired:
+            conversion_status.remove(task_id)
+        active = {task_id for task_id, _ in conversion_status.active(ACTIVE_STATUSES + ('uploading',))}
+        purge_work_files(TEMP_DIR, RESULT_RETENTION_SECONDS, active)
+    for job in expired.values():
+        remove_result_files(job, OUTPUT_DIR)
+    if expired:
+        print(f"✓ Removed {len(expired)} expired results")
+
+
+def watch_expired_results():
+    """Esegue purge_expired_results a intervalli regolari"""
+    while True:
+        try:
+            purge_expired_results()
+        except Exception as e:
+            print(f"Error during result cleanup: {e}")
+        time.sleep(RETENTION_CHECK_INTERVAL)
+
+
+def convert_task(task_id, youtube_url, audio_format, resume=None):
+    """
+    Esegue la conversione in un thread separato
+    
+    Args:
+        resume: Stato fuso dal journal per un job ripreso dopo un riavvio;
+                le fasi già completate (download, encode) non vengono ripetute
+    """
+    cancel_event = get_cancel_event(task_id)
+    
+    def report(**fields):
+        # Un task annullato resta 'cancelled' anche se la pipeline sta ancora chiudendo
+        if not cancel_event.is_set():
+            conversion_status.update(task_id, **fields)
+    
     try:
-        print(f"[convert_task] Starting conversion for task_id: {task_id}")
-        with conversion_status_lock:
-            # Ensure task exists (should already exist from /convert endpoint, but be safe)
-            if task_id not in conversion_status:
-                print(f"⚠ Warning: Task {task_id} not found, creating it now")
-                conversion_status[task_id] = {
-                    'status': 'downloading',
-                    'progress': 10,
-                    'message': 'Starting download...',
-                    'file': None,
-                    'error': None
-                }
-            else:
-                # Update status (task already exists from /convert endpoint)
-                conversion_status[task_id].update({
-                    'status': 'downloading',
-                    'progress': 10,
-                    'message': 'Starting download...'
-                })
-            print(f"[convert_task] Task {task_id} status updated, total tasks: {len(conversion_status)}")
-        
-        # Download video
-        with conversion_status_lock:
-            conversion_status[task_id].update({
-                'progress': 20,
-                'message': 'Downloading video...'
-            })
-        video_path, video_info = converter.download_video(youtube_url)
-        
-        with conversion_status_lock:
-            conversion_status[task_id].update({
-                'progress': 40,
-                'message': 'Download completed'
-            })
-        time.sleep(0.5)  # Small pause to show message
-        
-        # Convert to audio
-        with conversion_status_lock:
-            conversion_status[task_id].update({
-                'progress': 50,
-                'message': 'Converting to ' + audio_format.upper() + '...'
-            })
-        temp_audio_path = converter.convert_to_audio(video_path, audio_format)
-        
-        with conversion_status_lock:
-            conversion_status[task_id].update({
-                'progress': 60,
-                'message': 'Conversion completed'
-            })
-        time.sleep(0.5)
-        
-        # Audio analysis
-        with conversion_status_lock:
-            conversion_status[task_id].update({
-                'progress': 70,
-                'message': 'Analyzing track: BPM & key detection...'
-            })
-        bpm, scale = converter.analyze_audio(temp_audio_path)
-        
-        with conversion_status_lock:
-            conversion_status[task_id].update({
-                'progress': 85,
-                'message': 'Analysis completed'
-            })
-        time.sleep(0.5)
-        
-        # Genera nome file e rinomina
-        title = video_info.get('title', 'Track')
-        custom_filename = converter.generate_filename(title, bpm, scale, audio_format)
-        final_output_path = os.path.join(converter.temp_dir, custom_filename)
-        
-        if os.path.exists(temp_audio_path):
-            if os.path.exists(final_output_path):
-                os.remove(final_output_path)
-            os.rename(temp_audio_path, final_output_path)
-        
-        # Pulisce file video temporaneo
-        if video_path and os.path.exists(video_path):
-            try:
-                os.remove(video_path)
-            except:
-                pass
-        
-        with conversion_status_lock:
-            conversion_status[task_id].update({
-                'status': 'completed',
-                'progress': 100,
-                'message': 'Ready for download',
-                'file': final_output_path
-            })
+        result = run_conversion(
+            converter, task_id, youtube_url, audio_format,
+            output_dir=OUTPUT_DIR,
+            report=report,
+            checkpoint=lambda event, **fields: record(task_id, event, **fields),
+            cancel_event=cancel_event,
+            resume=resume,
+            probed_info=probed_infos.pop(task_id, None)
+        )
+        # Picchi e loudness restano nel journal: dopo un riavvio non serve ricalcolarli
+        record(task_id, 'completed', **result)
+        conversion_status.update(task_id, status='completed', progress=100, message='Ready for download',
+                                 **result)
+    
+    except ConversionCancelled:
+        # Ribadisce lo stato finale (cancel_task lo ha già scritto, lo store non lo lascia sovrascrivere)
+        conversion_status.update(task_id, status='cancelled')
     
     except Exception as e:
         error_msg = str(e)
         print(f"Error during conversion: {error_msg}")
         print(traceback.format_exc())
-        with conversion_status_lock:
-            conversion_status[task_id] = {
-                'status': 'error',
-                'progress': 0,
-                'message': 'Error during conversion',
-                'error': error_msg,
-                'file': None
-            }
+        record(task_id, 'error', error=error_msg)
+        conversion_status.update(task_id, status='error', progress=0, message='Error during conversion',
+                                 error=error_msg, file=None)
+    
+    finally:
+        # Task in stato finale: l'evento di annullamento non serve più
+        cancel_events.pop(task_id, None)
 
 
 @app.route('/convert', methods=['POST'])
@@ -180,57 +331,40 @@ def convert():
             return jsonify({"error": "YouTube URL missing"}), 400
         
         # Format validation
-        valid_formats = ['mp3', 'wav', 'flac', 'ogg', 'm4a', 'opus']
-        if audio_format not in valid_formats:
+        if audio_format not in VALID_FORMATS:
             print(f"ERROR: Unsupported format: {audio_format}")
-            return jsonify({"error": f"Unsupported format. Valid formats: {', '.join(valid_formats)}"}), 400
+            return jsonify({"error": f"Unsupported format. Valid formats: {', '.join(VALID_FORMATS)}"}), 400
         
         # Generate unique task_id
         task_id = str(uuid.uuid4())
         print(f"Generated task_id: {task_id}")
         
-        # Initialize task status BEFORE starting thread
+        # Initialize task status BEFORE submitting
         # This ensures the task is always available for status checks
-        with conversion_status_lock:
-            conversion_status[task_id] = {
-                'status': 'pending',
-                'progress': 0,
-                'message': 'Initializing conversion...',
-                'file': None,
-                'error': None
-            }
-            
-            # Verify task was added (safety check)
-            if task_id not in conversion_status:
-                print(f"ERROR: Task {task_id} was not added to conversion_status!")
-                return jsonify({"error": "Failed to initialize task"}), 500
-            
-            print(f"✓ Task {task_id} initialized in conversion_status (total tasks: {len(conversion_status)})")
-            print(f"   Task details: {conversion_status[task_id]}")
-        
-        # Start conversion in separate thread
-        thread = threading.Thread(target=convert_task, args=(task_id, youtube_url, audio_format))
-        thread.daemon = True
-        thread.start()
-        
-        print(f"Thread started for task_id: {task_id}")
+        client_id = get_client_id()
+        record(task_id, 'submitted', url=youtube_url, format=audio_format, client_id=client_id)
+        get_cancel_event(task_id)
+        conversion_status.create(task_id, {
+            'status': 'pending',
+            'progress': 0,
+            'message': 'Initializing conversion...',
+            'file': None,
+            'error': None,
+            'last_poll': time.time()
+        })
+        print(f"✓ Task {task_id} initialized (total tasks: {len(conversion_status)})")
         
-        # Verify task still exists after thread start
-        with conversion_status_lock:
-            if task_id not in conversion_status:
-                print(f"ERROR: Task {task_id} disappeared after thread start!")
-                return jsonify({"error": "Task lost after thread creation"}), 500
-            print(f"✓ Task {task_id} verified after thread start (total: {len(conversion_status)})")
+        # Submit to the scheduler (metadata probe first, then queued by estimated cost)
+        scheduler.submit(
+            task_id,
+            client_id,
+            probe=lambda: probe_task(task_id, youtube_url),
+            run=lambda: convert_task(task_id, youtube_url, audio_format),
+            on_error=reject_task,
+            payload={'url': youtube_url, 'format': audio_format}
+        )
         
-        # Small delay to ensure task is fully registered before returning response
-        time.sleep(0.1)
-        
-        # Final verification before returning
-        with conversion_status_lock:
-            if task_id not in conversion_status:
-                print(f"ERROR: Task {task_id} disappeared before returning response!")
-                return jsonify({"error": "Task lost before response"}), 500
-            print(f"✓ Final check: Task {task_id} exists (total: {len(conversion_status)})")
+        print(f"Task {task_id} submitted to scheduler (client: {client_id})")
         
         response_data = {"task_id": task_id}
         response = jsonify(response_data)
@@ -245,46 +379,189 @@ def convert():
         return jsonify({"error": f"Error: {error_msg}"}), 500
 
 
-@app.route('/status/<task_id>', methods=['GET'])
-def get_status(task_id):
-    """Endpoint to get conversion status"""
-    with conversion_status_lock:
-        print(f"Status check for task_id: {task_id}")
-        print(f"Total tasks in memory: {len(conversion_status)}")
-        if len(conversion_status) > 0:
-            print(f"Available task IDs (first 5): {list(conversion_status.keys())[:5]}")
+@app.route('/convert/upload', methods=['POST'])
+def convert_upload():
+    """
+    Endpoint to convert an uploaded file (multipart/form-data or raw/chunked body).
+    
+    The body is streamed straight into ffmpeg: nothing is buffered in memory
+    or written to disk before the conversion. Query params: format (default mp3),
+    title (default: uploaded file name). The result is available via /download/<task_id>.
+    """
+    audio_format = request.args.get('format', 'mp3')
+    if audio_format not in VALID_FORMATS:
+        return jsonify({"error": f"Unsupported format. Valid formats: {', '.join(VALID_FORMATS)}"}), 400
+    
+    if request.content_length and request.content_length > MAX_UPLOAD_BYTES:
+        return jsonify({"error": f"Upload too large. Maximum size is {MAX_UPLOAD_BYTES} bytes"}), 413
+    
+    if job_queue is not None:
+        # Solo API: ffmpeg e analisi girano nei worker, che però leggono i job dalla coda e non dal body
+        return jsonify({"error": "Uploads are not available on this server (API-only mode)"}), 503
+    
+    client_id = get_client_id()
+    if not acquire_upload_slot(client_id):
+        response = jsonify({"error": "Too many uploads in progress. Please retry later."})
+        response.headers['Retry-After'] = '10'
+        return response, 429
+    task_id = str(uuid.uuid4())
+    try:
+        return run_upload(task_id, audio_format)
+    finally:
+        release_upload_slot(client_id)
+        cancel_events.pop(task_id, None)
+
+
+def acquire_upload_slot(client_id):
+    """
+    Returns:
+        bool: False se sono già in corso MAX_CONCURRENT_UPLOADS upload, o MAX_UPLOADS_PER_CLIENT del client
+    """
+    with upload_stats_lock:
+        if sum(uploads_in_progress.values()) >= MAX_CONCURRENT_UPLOADS:
+            return False
+        if uploads_in_progress.get(client_id, 0) >= MAX_UPLOADS_PER_CLIENT:
+            return False
+        uploads_in_progress[client_id] = uploads_in_progress.get(client_id, 0) + 1
+        return True
+
+
+def release_upload_slot(client_id):
+    """Libera lo slot preso con acquire_upload_slot"""
+    with upload_stats_lock:
+        uploads_in_progress[client_id] -= 1
+        if not uploads_in_progress[client_id]:
+            del uploads_in_progress[client_id]
+
+
+def run_upload(task_id, audio_format):
+    """Riceve l'upload in streaming, lo converte e lo analizza (con uno slot upload già preso)"""
+    cancel_event = get_cancel_event(task_id)
+    # 'uploading' non è tra gli ACTIVE_STATUSES: l'upload è legato alla richiesta,
+    # il watchdog dei task abbandonati non deve interromperlo
+    conversion_status.create(task_id, {
+        'status': 'uploading',
+        'progress': 10,
+        'message': 'Receiving upload...',
+        'file': None,
+        'error': None,
+        'last_poll': time.time()
+    })
+    
+    upload = UploadStream(request.stream, request.mimetype, request.mimetype_params, MAX_UPLOAD_BYTES)
+    temp_audio_path = os.path.join(converter.temp_dir, f"upload-{task_id}.{audio_format}")
+    peaks_path = os.path.join(OUTPUT_DIR, f"{task_id}.peaks")
+    waveform = WaveformAnalyzer()
+    started = time.perf_counter()
+    try:
+        # Lo stesso PCM decodificato per l'encode alimenta waveform, loudness e analisi
+        converter.convert_to_audio(None, audio_format, output_path=temp_audio_path,
+                                   cancel_event=cancel_event, input_chunks=upload, pcm_sink=waveform.feed)
+        if waveform.channels is None or not len(waveform.head()[0]):
+            # ffmpeg può uscire senza errori anche senza aver decodificato nulla (es. MP4 non faststart)
+            raise ValueError(f"No audio could be decoded from the upload. {NOT_FASTSTART_MESSAGE}")
+        upload_seconds = time.perf_counter() - started
+        conversion_status.update(task_id, progress=70, message='Analyzing track: BPM & key detection...')
         
-        if task_id not in conversion_status:
-            print(f"⚠ Task {task_id} not found in conversion_status")
-            print(f"   This could be a race condition or the task was never created")
-            print(f"   Request timestamp: {time.time()}")
-            print(f"   Checking if /convert was called for this task...")
-            # Verifica se il task esisteva prima
-            return jsonify({
-                "error": "Task not found", 
-                "task_id": task_id,
-                "available_tasks": len(conversion_status),
-                "suggestion": "The task may not have been created. Check /convert endpoint logs."
-            }), 404
+        bpm, scale = converter.analyze_audio(temp_audio_path, cancel_event=cancel_event, samples=waveform.head())
+        loudness = waveform.integrated_loudness()
+        waveform.write_peaks(peaks_path)
         
-        status = conversion_status[task_id].copy()
-        print(f"✓ Task {task_id} found, status: {status.get('status')}, progress: {status.get('progress')}%")
-        return jsonify(status)
+        title = request.args.get('title') or os.path.splitext(upload.filename or '')[0] or 'Track'
+        final_output_path = os.path.join(OUTPUT_DIR, converter.generate_filename(title, bpm, scale, audio_format))
+        if os.path.exists(final_output_path):
+            os.remove(final_output_path)
+        shutil.move(temp_audio_path, final_output_path)
+    
+    except Exception as e:
+        for path in (temp_audio_path, peaks_path):
+            if os.path.exists(path):
+                os.remove(path)
+        with upload_stats_lock:
+            upload_stats['failed'] += 1
+        if isinstance(e, ConversionCancelled):
+            return jsonify({"error": "Conversion cancelled", "task_id": task_id}), 409
+        error_msg = str(e)
+        conversion_status.update(task_id, status='error', progress=0, message='Error during conversion',
+                                 error=error_msg, file=None)
+        if isinstance(e, UploadTooLarge):
+            return jsonify({"error": error_msg, "task_id": task_id}), 413
+        if isinstance(e, ValueError):
+            return jsonify({"error": error_msg, "task_id": task_id}), 400
+        print(f"Error during upload conversion: {error_msg}")
+        print(traceback.format_exc())
+        return jsonify({"error": f"Error: {error_msg}", "task_id": task_id}), 500
+    
+    upload_metrics = {
+        'bytes': upload.bytes_received,
+        'seconds': round(upload_seconds, 3),
+        'throughput_mbps': round(upload.bytes_received * 8 / 1e6 / upload_seconds, 2) if upload_seconds else None
+    }
+    with upload_stats_lock:
+        upload_stats['uploads'] += 1
+        upload_stats['bytes'] += upload.bytes_received
+        upload_stats['seconds'] += upload_seconds
+    
+    # Nel journal solo per la retention e per /download dopo un riavvio (non c'è nulla da riprendere)
+    record(task_id, 'completed', file=final_output_path, peaks=peaks_path, loudness_lufs=loudness,
+           bpm=bpm, key=scale)
+    conversion_status.update(task_id, status='completed', progress=100, message='Ready for download',
+                             file=final_output_path, peaks=peaks_path, loudness_lufs=loudness,
+                             bpm=bpm, key=scale, upload=upload_metrics)
+    return jsonify({
+        "task_id": task_id,
+        "file": os.path.basename(final_output_path),
+        "bpm": bpm,
+        "key": scale,
+        "loudness_lufs": loudness,
+        "peaks": f"/peaks/{task_id}",
+        "upload": upload_metrics
+    })
+
+
+@app.route('/status/<task_id>', methods=['GET'])
+def get_status(task_id):
+    """
+    Endpoint to get conversion status.
+    
+    Hot path (polled continuously by every client): no global lock and no logging,
+    the response is the task's current immutable snapshot.
+    """
+    if not conversion_status.touch(task_id):
+        return jsonify({
+            "error": "Task not found", 
+            "task_id": task_id,
+            "available_tasks": len(conversion_status),
+            "suggestion": "The task may not have been created. Check /convert endpoint logs."
+        }), 404
+    
+    return jsonify(conversion_status.get(task_id))
+
+
+@app.route('/task/<task_id>', methods=['DELETE'])
+def delete_task(task_id):
+    """Endpoint to cancel a conversion (aborts download, ffmpeg and analysis)"""
+    if conversion_status.get(task_id) is None:
+        return jsonify({"error": "Task not found"}), 404
+    
+    if not cancel_task(task_id, 'cancelled by user'):
+        return jsonify({"error": "Task already finished"}), 409
+    
+    return jsonify({"task_id": task_id, "status": "cancelled"})
 
 
 @app.route('/download/<task_id>', methods=['GET'])
 def download_file(task_id):
     """Endpoint to download converted file"""
-    with conversion_status_lock:
-        if task_id not in conversion_status:
-            return jsonify({"error": "Task not found"}), 404
-        
-        status = conversion_status[task_id]
+    status = conversion_status.get(task_id)
+    if status is None:
+        return jsonify({"error": "Task not found"}), 404
     
     if status['status'] != 'completed' or not status.get('file'):
         return jsonify({"error": "File not ready yet"}), 400
     
-    file_path = status['file']
+    # Il file viene sempre servito dalla directory di output condivisa
+    file_path = os.path.join(OUTPUT_DIR, os.path.basename(status['file']))
     if not os.path.exists(file_path):
         return jsonify({"error": "File not found"}), 404
     
@@ -296,21 +573,154 @@ def download_file(task_id):
     )
 
 
+@app.route('/peaks/<task_id>', methods=['GET'])
+def download_peaks(task_id):
+    """
+    Endpoint to get the precomputed waveform peaks (binary .peaks file, see waveform.py).
+    
+    The file never changes once the task is completed, so it is served with
+    ETag/Last-Modified and a long immutable Cache-Control. The integrated
+    loudness is returned in the X-Loudness-LUFS header.
+    """
+    status = conversion_status.get(task_id)
+    if status is None:
+        return jsonify({"error": "Task not found"}), 404
+    
+    if status['status'] != 'completed' or not status.get('peaks'):
+        return jsonify({"error": "Peaks not ready yet"}), 400
+    
+    peaks_path = os.path.join(OUTPUT_DIR, os.path.basename(status['peaks']))
+    if not os.path.exists(peaks_path):
+        return jsonify({"error": "Peaks not found"}), 404
+    
+    response = send_file(
+        peaks_path,
+        mimetype='application/octet-stream',
+        conditional=True,
+        etag=True,
+        max_age=PEAKS_MAX_AGE
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    if status.get('loudness_lufs') is not None:
+        response.headers['X-Loudness-LUFS'] = str(status['loudness_lufs'])
+    return response
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Endpoint per verificare lo stato del server"""
-    return jsonify({"status": "ok"})
+    return jsonify({
+        "status": "ok",
+        "cpu": converter.cpu_budget.utilization(),
+        "queue": job_queue.stats() if job_queue is not None else scheduler.stats(),
+        "uploads": upload_metrics_summary()
+    })
+
+
+def upload_metrics_summary():
+    """Metriche cumulative degli upload, con throughput medio in Mbit/s"""
+    with upload_stats_lock:
+        stats = dict(upload_stats)
+        stats['in_progress'] = sum(uploads_in_progress.values())
+    stats['seconds'] = round(stats['seconds'], 3)
+    stats['throughput_mbps'] = round(stats['bytes'] * 8 / 1e6 / stats['seconds'], 2) if stats['seconds'] else None
+    return stats
+
+
+
+
+def restore_jobs():
+    """
+    Ripristina i job dal journal dopo un riavvio.
+    
+    - task completati il cui file esiste ancora: tornano disponibili per /download
+    - task non terminati: rimessi in coda, riprendendo dall'ultima fase completata
+    Il journal viene poi compattato con i soli task ripristinati.
+    """
+    keep = {}
+    requeued = 0
+    now = time.time()
+    for task_id, job in journal.replay().items():
+        event = job.get('event')
+        if event == 'completed':
+            if job.get('file') and os.path.exists(job['file']):
+                keep[task_id] = job
+                conversion_status.create(task_id, {
+                    'status': 'completed',
+                    'progress': 100,
+                    'message': 'Ready for download',
+                    'file': job['file'],
+                    'peaks': job.get('peaks'),
+                    'loudness_lufs': job.get('loudness_lufs'),
+                    'bpm': job.get('bpm'),
+                    'key': job.get('key'),
+                    'error': None,
+                    'last_poll': now
+                })
+            continue
+        if event in JobJournal.FINAL_EVENTS or not job.get('url'):
+            continue
+        
+        keep[task_id] = job
+        conversion_status.create(task_id, {
+            'status': 'queued',
+            'progress': 5,
+            'message': 'Resuming after server restart...',
+            'file': None,
+            'error': None,
+            'duration': job.get('duration'),
+            # Escluso dal watchdog degli abbandoni finché il client non torna a fare polling
+            'last_poll': None
+        })
+        client_id = job.get('client_id', 'restored')
+        run = lambda task_id=task_id, job=job: convert_task(task_id, job['url'], job['format'], resume=job)
+        if 'cost' in job:
+            scheduler.enqueue(ScheduledJob(task_id, client_id, run, job['cost']))
+        else:
+            # Non ancora ammesso prima del riavvio: ripete il probe (e il controllo durata)
+            scheduler.submit(
+                task_id,
+                client_id,
+                probe=lambda task_id=task_id, job=job: probe_task(task_id, job['url']),
+                run=run,
+                on_error=reject_task
+            )
+        requeued += 1
+    
+    journal.compact(keep)
+    if keep:
+        print(f"✓ Restored {len(keep)} tasks from journal ({requeued} requeued)")
+
+
+if journal is not None:
+    restore_jobs()
+
 
+# Watchdog per i task abbandonati (nessun polling di /status)
+abandoned_watcher = threading.Thread(target=watch_abandoned_tasks, name='abandoned-task-watcher')
+abandoned_watcher.daemon = True
+abandoned_watcher.start()
 
+# Retention di risultati e file di lavoro (RESULT_RETENTION_HOURS=0 la disattiva)
+if RESULT_RETENTION_SECONDS > 0:
+    retention_watcher = threading.Thread(target=watch_expired_results, name='result-retention')
+    retention_watcher.daemon = True
+    retention_watcher.start()
 
 
 if __name__ == '__main__':
-    # Check if ffmpeg is available
-    print("Checking for ffmpeg...")
-    if not converter.check_ffmpeg():
-        print("ERROR: ffmpeg not found. Make sure it's installed on the system.")
-        exit(1)
-    print("✓ ffmpeg found")
+    if job_queue is not None:
+        # Le conversioni girano nei worker: qui ffmpeg non serve (e /convert/upload risponde 503)
+        print(f"API-only mode: jobs go to the shared queue {JOB_QUEUE_DB} (start workers on this host with: python -m worker)")
+        print("   /convert/upload is disabled in this mode")
+    else:
+        # Check if ffmpeg is available
+        print("Checking for ffmpeg...")
+        if not converter.check_ffmpeg():
+            print("ERROR: ffmpeg not found. Make sure it's installed on the system.")
+            exit(1)
+        print("✓ ffmpeg found")
     
     # Get port from environment variable or use default
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,129 @@
+"""
+Micro-benchmark del polling di /status con molti task tracciati.
+
+Popola lo store dei task con N task (default 10k), avvia alcuni thread che
+aggiornano il progresso dei task come fanno i job in esecuzione e misura
+quante letture di stato al secondo riescono a fare i thread di polling:
+
+- store: touch() + get() su LocalTaskStore, come fa /status
+- endpoint: GET /status/<task_id> completo tramite il test client di Flask
+
+    python bench_status.py --tasks 10000 --pollers 8 --writers 4 --seconds 5
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from task_store import LocalTaskStore
+
+
+def populate(store, tasks):
+    task_ids = [str(uuid.uuid4()) for _ in range(tasks)]
+    for task_id in task_ids:
+        store.create(task_id, {
+            'status': 'downloading',
+            'progress': 0,
+            'message': 'Starting download...',
+            'file': None,
+            'error': None,
+            'last_poll': time.time()
+        })
+    return task_ids
+
+
+def run_threads(store, task_ids, poll, pollers, writers, seconds):
+    """
+    Esegue poll(task_id) in loop su pollers thread mentre writers thread
+    aggiornano lo stato dei task.
+
+    Returns:
+        tuple: (letture al secondo, scritture al secondo)
+    """
+    stop = threading.Event()
+    reads = [0] * pollers
+    writes = [0] * writers
+
+    def poller(slot):
+        rng = random.Random(slot)
+        count = 0
+        while not stop.is_set():
+            poll(rng.choice(task_ids))
+            count += 1
+        reads[slot] = count
+
+    def writer(slot):
+        rng = random.Random(1000 + slot)
+        count = 0
+        while not stop.is_set():
+            store.update(rng.choice(task_ids), progress=rng.randint(0, 100), message='Converting...')
+            count += 1
+        writes[slot] = count
+
+    threads = [threading.Thread(target=poller, args=(i,)) for i in range(pollers)]
+    threads += [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    # Tempo reale, non quello richiesto: con un lock conteso i thread possono fermarsi molto dopo
+    elapsed = time.perf_counter() - started
+    return sum(reads) / elapsed, sum(writes) / elapsed
+
+
+def bench_store(tasks, pollers, writers, seconds):
+    store = LocalTaskStore()
+    task_ids = populate(store, tasks)
+
+    def poll(task_id):
+        store.touch(task_id)
+        return store.get(task_id)
+
+    return run_threads(store, task_ids, poll, pollers, writers, seconds)
+
+
+def bench_endpoint(tasks, pollers, writers, seconds):
+    # app.py crea journal e file di lavoro in WORK_DIR all'import: li teniamo in una directory usa e getta
+    os.environ['WORK_DIR'] = tempfile.mkdtemp(prefix='bench-status-')
+    os.environ.pop('JOB_QUEUE_DB', None)
+    import app
+
+    store = app.conversion_status
+    task_ids = populate(store, tasks)
+    clients = threading.local()
+
+    def poll(task_id):
+        client = getattr(clients, 'client', None)
+        if client is None:
+            client = clients.client = app.app.test_client()
+        response = client.get(f'/status/{task_id}')
+        assert response.status_code == 200
+
+    return run_threads(store, task_ids, poll, pollers, writers, seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--pollers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--store-only', action='store_true', help='Skip the Flask endpoint benchmark')
+    args = parser.parse_args()
+
+    print(f"{args.tasks} tasks, {args.pollers} pollers, {args.writers} writers, {args.seconds}s per run")
+    benches = [('store', bench_store)]
+    if not args.store_only:
+        benches.append(('/status', bench_endpoint))
+    for name, bench in benches:
+        reads, writes = bench(args.tasks, args.pollers, args.writers, args.seconds)
+        print(f"{name:>8}: {reads:>12,.0f} reads/s  {writes:>12,.0f} writes/s")
+
+
+if __name__ == '__main__':
+    main()
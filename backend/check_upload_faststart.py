@@ -0,0 +1,70 @@
+"""
+Controllo di regressione di /convert/upload con file MP4/M4A.
+
+Genera con ffmpeg due M4A con lo stesso audio (tono di 5 s):
+
+- faststart (moov atom all'inizio): deve essere convertito (200, loudness misurata)
+- moov atom in fondo (default di ffmpeg): da una pipe non è decodificabile, deve
+  essere rifiutato con 400 e il messaggio sul faststart, senza lasciare file.
+  ffmpeg 7 in questo caso esce con 0 e "partial file" senza decodificare nulla.
+
+    python check_upload_faststart.py
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+
+def make_m4a(path, faststart):
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', 'sine=frequency=440:duration=5',
+           '-c:a', 'aac']
+    if faststart:
+        cmd += ['-movflags', '+faststart']
+    subprocess.run(cmd + [path], check=True)
+
+
+def upload(client, path):
+    with open(path, 'rb') as f:
+        response = client.post('/convert/upload?format=flac&title=check', data=f.read(),
+                               content_type='audio/mp4')
+    return response.status_code, response.get_json()
+
+
+def main():
+    # app.py crea journal e file di lavoro in WORK_DIR all'import: li teniamo in una directory usa e getta
+    work_dir = tempfile.mkdtemp(prefix='check-upload-')
+    os.environ['WORK_DIR'] = work_dir
+    os.environ.pop('JOB_QUEUE_DB', None)
+    import app
+
+    client = app.app.test_client()
+    failures = []
+
+    faststart_path = os.path.join(tempfile.mkdtemp(), 'faststart.m4a')
+    make_m4a(faststart_path, faststart=True)
+    status, body = upload(client, faststart_path)
+    print(f"faststart: {status} {body}")
+    if status != 200 or body.get('loudness_lufs') is None:
+        failures.append('faststart upload was not converted')
+
+    moov_at_end_path = os.path.join(tempfile.mkdtemp(), 'moov-at-end.m4a')
+    make_m4a(moov_at_end_path, faststart=False)
+    status, body = upload(client, moov_at_end_path)
+    print(f"moov at end: {status} {body}")
+    if status != 400 or 'faststart' not in (body or {}).get('error', ''):
+        failures.append('moov-at-end upload was not rejected with the faststart error')
+    task_id = (body or {}).get('task_id')
+    leftovers = [name for name in os.listdir(work_dir) if task_id and task_id in name]
+    if leftovers:
+        failures.append(f'moov-at-end upload left files behind: {leftovers}')
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
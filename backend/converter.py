@@ -1,4 +1,11 @@
 import os
+from cpu_budget import CPUBudget
+
+# L'analisi occupa ANALYSIS_TOKENS core del budget: BLAS/OpenMP/numba non devono
+# aprire un thread per core. Va fissato prima che numpy e librosa vengano importati.
+for _var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMBA_NUM_THREADS'):
+    os.environ.setdefault(_var, str(CPUBudget.ANALYSIS_TOKENS))
+
 import subprocess
 import yt_dlp
 import tempfile
@@ -7,20 +14,85 @@ import re
 import librosa
 import numpy as np
 import uuid
+import threading
+import time
+from yt_dlp.cookies import YoutubeDLCookieJar, extract_cookies_from_browser
+from waveform import PCM_SAMPLE_RATE, PCM_CHANNEL_LAYOUTS
+
+
+class ConversionCancelled(Exception):
+    """Conversione annullata dall'utente (o per abbandono del task)"""
+    pass
+
+
+class LeaseLost(ConversionCancelled):
+    """Job passato a un altro worker (lease scaduto): i suoi file di lavoro ora sono del nuovo worker"""
+    pass
+
+
+class CancelEvent(threading.Event):
+    """
+    Evento di annullamento che distingue il motivo dello stop.
+
+    set() è un annullamento: i file parziali vengono rimossi. hand_over() ferma il job
+    perché è passato a un altro worker: si solleva LeaseLost e i file di lavoro
+    (stessi nomi per entrambi i worker) non vengono toccati.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.handed_over = False
+
+    def hand_over(self):
+        self.handed_over = True
+        self.set()
+
+
+# Upload MP4/M4A/MOV con l'indice (moov atom) in fondo: da una pipe ffmpeg non può
+# saltare alla fine del file a leggerlo, quindi non decodifica nulla
+NOT_FASTSTART_MESSAGE = (
+    "Unsupported upload: MP4/M4A/MOV files must be 'faststart' (moov atom at the "
+    "beginning) to be streamed. Re-export the file with faststart, e.g. "
+    "ffmpeg -i input.mp4 -c copy -movflags +faststart output.mp4"
+)
+
+
+def cancellation(cancel_event):
+    """Eccezione per un cancel_event impostato: LeaseLost se il job è passato a un altro worker"""
+    if getattr(cancel_event, 'handed_over', False):
+        return LeaseLost("Job lease lost to another worker")
+    return ConversionCancelled("Conversion cancelled")
 
 
 class YouTubeAudioConverter:
     """Classe per convertire video YouTube in file audio"""
     
-    def __init__(self, temp_dir=None):
+    # Bitrate minimo (kbps) della sorgente oltre il quale l'encoder di
+    # convert_to_audio non guadagna più qualità. None = formato lossless,
+    # serve sempre la miglior sorgente disponibile.
+    SOURCE_MIN_ABR = {
+        'mp3': 160,   # libmp3lame -q:a 0 (V0)
+        'ogg': 112,   # libvorbis default (q3)
+        'm4a': 128,   # aac default
+        'opus': 96,   # libopus default
+        'wav': None,
+        'flac': None,
+    }
+    
+    # Frammenti scaricati in parallelo per le sorgenti DASH/HLS
+    CONCURRENT_FRAGMENTS = int(os.environ.get('YTDLP_CONCURRENT_FRAGMENTS', 4))
+    
+    def __init__(self, temp_dir=None, cpu_budget=None):
         """
         Inizializza il converter
         
         Args:
             temp_dir: Directory per file temporanei (default: tempfile.gettempdir())
+            cpu_budget: CPUBudget condiviso tra encoding e analisi (default: uno nuovo)
         """
         self.temp_dir = temp_dir or tempfile.gettempdir()
         self.ensure_temp_dir()
+        self.cpu_budget = cpu_budget or CPUBudget()
         
         # Path del file cookies (se presente)
         # Può essere configurato via variabile d'ambiente COOKIES_FILE
@@ -32,15 +104,113 @@ class YouTubeAudioConverter:
             backend_dir = os.path.dirname(os.path.abspath(__file__))
             self.cookies_path = os.path.join(backend_dir, 'cookies.txt')
         
-        # Verifica se il file cookies esiste
-        if os.path.exists(self.cookies_path):
-            file_size = os.path.getsize(self.cookies_path)
-            print(f"✓ Cookies file found: {self.cookies_path} ({file_size} bytes)")
+        # Cookie jar condiviso tra tutte le istanze YoutubeDL:
+        # caricato una volta sola e ricaricato solo se cambia l'mtime del file
+        self._cookie_jar = None
+        self._cookie_mtime = None
+        self._cookie_lock = threading.Lock()
+        
+        # Profilo browser da cui estrarre i cookies (None = nessun browser installato)
+        self.browser_profile = self._find_browser_profile()
+        
+        # Carica subito i cookies (un solo stat + parse)
+        cookie_jar = self.get_cookie_jar()
+        if self._cookie_mtime is not None:
+            print(f"✓ Cookies file loaded: {self.cookies_path}")
+        if self.browser_profile is not None:
+            print(f"✓ Browser cookies enabled: {self.browser_profile}")
+        if cookie_jar is not None and len(cookie_jar):
+            print(f"✓ {len(cookie_jar)} cookies available for YouTube downloads")
         else:
-            print(f"⚠ Cookies file not found at: {self.cookies_path}")
+            if self._cookie_mtime is None:
+                print(f"⚠ Cookies file not found at: {self.cookies_path}")
             print(f"   YouTube downloads may fail with bot detection errors.")
             print(f"   Tip: Use yt-dlp --cookies-from-browser chrome --cookies cookies.txt to extract cookies")
     
+    def _find_browser_profile(self):
+        """
+        Cerca un profilo browser da cui yt-dlp possa estrarre i cookies.
+        
+        Returns:
+            str | None: Spec per cookiesfrombrowser (es. 'chrome' o 'chrome:<path>'),
+                        None se nessun profilo esiste su questa macchina
+        """
+        home = os.path.expanduser('~')
+        local_app_data = os.environ.get('LOCALAPPDATA', '')
+        app_data = os.environ.get('APPDATA', '')
+        candidates = [
+            ('chrome', os.path.join(home, '.config', 'google-chrome')),
+            ('chrome', os.path.join(home, '.var', 'app', 'com.google.Chrome', 'config', 'google-chrome')),
+            ('chrome', os.path.join(home, 'Library', 'Application Support', 'Google', 'Chrome')),
+            ('chrome', os.path.join(local_app_data, 'Google', 'Chrome', 'User Data')),
+            ('chromium', os.path.join(home, '.config', 'chromium')),
+            ('firefox', os.path.join(home, '.mozilla', 'firefox')),
+            ('firefox', os.path.join(home, 'Library', 'Application Support', 'Firefox')),
+            ('firefox', os.path.join(app_data, 'Mozilla', 'Firefox')),
+            ('edge', os.path.join(home, '.config', 'microsoft-edge')),
+            ('edge', os.path.join(local_app_data, 'Microsoft', 'Edge', 'User Data')),
+            ('brave', os.path.join(home, '.config', 'BraveSoftware', 'Brave-Browser')),
+            ('opera', os.path.join(home, '.config', 'opera')),
+        ]
+        for browser, profile_dir in candidates:
+            if os.path.isdir(profile_dir):
+                return f"{browser}:{profile_dir}"
+        return None
+    
+    def get_cookie_jar(self):
+        """
+        Restituisce il cookie jar condiviso, ricaricandolo solo se il file è cambiato.
+        
+        Il jar unisce i cookies del file (se presente) e quelli del profilo browser
+        (se presente). Se nessuna delle due sorgenti esiste restituisce None.
+        
+        Returns:
+            YoutubeDLCookieJar | None: Cookie jar da condividere tra le istanze YoutubeDL
+        """
+        try:
+            mtime = os.stat(self.cookies_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        
+        with self._cookie_lock:
+            if self._cookie_jar is not None and mtime == self._cookie_mtime:
+                return self._cookie_jar
+            if mtime is None and self.browser_profile is None:
+                self._cookie_jar = None
+                self._cookie_mtime = None
+                return None
+            
+            jar = YoutubeDLCookieJar()
+            
+            if self.browser_profile:
+                browser, _, profile = self.browser_profile.partition(':')
+                try:
+                    for cookie in extract_cookies_from_browser(browser, profile or None):
+                        jar.set_cookie(cookie)
+                    print(f"✓ Loaded cookies from browser profile {self.browser_profile}")
+                except Exception as e:
+                    print(f"⚠ Could not extract cookies from {self.browser_profile}: {str(e)[:200]}")
+            
+            if mtime is not None:
+                try:
+                    file_jar = YoutubeDLCookieJar(self.cookies_path)
+                    file_jar.load()
+                    for cookie in file_jar:
+                        jar.set_cookie(cookie)
+                except Exception as e:
+                    print(f"⚠ Could not load cookies file {self.cookies_path}: {str(e)[:200]}")
+            
+            self._cookie_jar = jar
+            self._cookie_mtime = mtime
+            return jar
+    
+    def _create_ydl(self, ydl_opts, cookie_jar=None):
+        """Crea un'istanza YoutubeDL che usa il cookie jar condiviso invece di rileggere i cookies"""
+        ydl = yt_dlp.YoutubeDL(ydl_opts)
+        if cookie_jar is not None:
+            ydl.cookiejar = cookie_jar
+        return ydl
+    
     def ensure_temp_dir(self):
         """Assicura che la directory temporanea esista"""
         os.makedirs(self.temp_dir, exist_ok=True)
@@ -74,7 +244,51 @@ class YouTubeAudioConverter:
         
         return True
     
-    def download_video(self, youtube_url, get_info_only=False):
+    def build_format_selector(self, audio_format=None, min_abr=None):
+        """
+        Builds the yt-dlp format selector for the given target format.
+        
+        Picks the smallest audio-only stream that does not limit the output
+        quality (abr >= the encoder's useful bitrate), then the best audio-only
+        stream, and only then falls back to muxed video streams.
+        
+        Args:
+            audio_format: Target audio format (mp3, wav, flac, ogg, m4a, opus)
+            min_abr: Override for the minimum useful source bitrate in kbps
+        
+        Returns:
+            str: yt-dlp format selector
+        """
+        if min_abr is None:
+            min_abr = self.SOURCE_MIN_ABR.get(audio_format)
+        
+        if not min_abr:
+            # Lossless target (or unknown format): best audio, muxed only as fallback
+            return 'bestaudio[vcodec=none]/bestaudio/best'
+        
+        return (
+            f'worstaudio[vcodec=none][abr>={min_abr}]'
+            f'/bestaudio[vcodec=none]'
+            f'/worst[acodec!=none][abr>={min_abr}]'
+            f'/best'
+        )
+    
+    def _check_cancelled(self, cancel_event):
+        """Solleva ConversionCancelled se il task è stato annullato"""
+        if cancel_event is not None and cancel_event.is_set():
+            raise cancellation(cancel_event)
+    
+    def _remove_files(self, paths):
+        """Rimuove file parziali/temporanei ignorando quelli già spariti"""
+        for path in paths:
+            if path and os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    
+    def download_video(self, youtube_url, get_info_only=False, audio_format=None, cancel_event=None,
+                       output_name=None, probed_info=None):
         """
         Downloads YouTube video as temporary file or extracts info only.
         
@@ -86,13 +300,25 @@ class YouTubeAudioConverter:
         Args:
             youtube_url: YouTube video URL
             get_info_only: If True, only extracts metadata without downloading
+            audio_format: Target audio format, used to pick the smallest
+                          source stream that does not limit output quality
+            cancel_event: threading.Event; when set, the download is aborted
+                          from the progress hook and partial files are removed
+            output_name: Stable file name (without extension) in temp_dir; when set,
+                         an interrupted download resumes from its .part file
+            probed_info: Info dict returned earlier by get_info_only=True (same process);
+                         the download reuses it instead of extracting again, and only
+                         falls back to a fresh extraction if that fails
         
         Returns:
             tuple: (video_path, video_info) if get_info_only=False
                    (None, video_info) if get_info_only=True
+                   video_info['downloaded_bytes'] holds the bytes transferred,
+                   video_info['timings'] the seconds spent per stage (cookies, download)
         
         Raises:
             ValueError: Invalid URL or playlist detected
+            ConversionCancelled: cancel_event was set
             FileNotFoundError: Video file not found after download
             Exception: Download failed after trying all clients (with clear error message)
         """
@@ -107,23 +333,54 @@ class YouTubeAudioConverter:
         player_clients_without_cookies = ['ios', 'android']  # Non supportano cookies
         
         # Prova prima con cookies (se disponibili), poi senza
-        has_cookies = os.path.exists(self.cookies_path)
+        timings = {}
+        started = time.perf_counter()
+        cookie_jar = self.get_cookie_jar()
+        timings['cookies'] = round(time.perf_counter() - started, 4)
+        has_cookies = cookie_jar is not None
         all_clients = player_clients_with_cookies + player_clients_without_cookies if has_cookies else player_clients_without_cookies
         
+        # Info già estratte dal probe: si riparte dallo stesso client senza una nuova estrazione
+        # (gli URL dei formati sono legati al client). Se il download fallisce (es. URL scaduti)
+        # lo stesso client viene riprovato più avanti con un'estrazione nuova.
+        if probed_info is not None and probed_info.get('_player_client') in all_clients:
+            all_clients = [probed_info['_player_client']] + all_clients
+        else:
+            probed_info = None
+        
+        format_selector = self.build_format_selector(audio_format)
+        
+        # Conta i byte effettivamente scaricati (per verificare il risparmio di banda)
+        # e tiene traccia dei file scritti, da rimuovere in caso di annullamento
+        download_stats = {'bytes': 0}
+        partial_files = set()
+        
+        def track_downloaded_bytes(d):
+            for key in ('tmpfilename', 'filename'):
+                if d.get(key):
+                    partial_files.add(d[key])
+            if d.get('status') == 'finished':
+                download_stats['bytes'] += d.get('downloaded_bytes') or d.get('total_bytes') or 0
+            # Interrompe il download di yt-dlp appena il task viene annullato
+            self._check_cancelled(cancel_event)
+        
         # Prova ogni client finché uno non funziona
         last_error = None
         for client in all_clients:
             try:
+                self._check_cancelled(cancel_event)
                 print(f"Trying YouTube client: {client}...")
                 
                 # Optimized yt-dlp configuration for cloud environments (Render, Docker, VPS)
                 # Force IPv4 - important for Render (often prefers IPv6 which breaks YouTube)
-                # Usa formato molto flessibile: preferisce audio, ma accetta qualsiasi formato disponibile
+                # Formato scelto in base al target: audio-only più piccolo che non limita la qualità,
+                # video muxato solo come ultima risorsa
                 ydl_opts = {
-                    # Formato molto permissivo: preferisce audio, ma accetta qualsiasi cosa disponibile
-                    # bestaudio/best accetta qualsiasi formato che contenga audio
-                    'format': 'bestaudio/best',
-                    'outtmpl': os.path.join(self.temp_dir, '%(title)s.%(ext)s'),
+                    'format': format_selector,
+                    'concurrent_fragment_downloads': self.CONCURRENT_FRAGMENTS,
+                    'progress_hooks': [track_downloaded_bytes],
+                    'outtmpl': os.path.join(self.temp_dir, f'{output_name or "%(title)s"}.%(ext)s'),
+                    'continuedl': True,  # Riprende i download interrotti dal file .part
                     'noplaylist': True,
                     'quiet': False,  # Mostra warnings per debug
                     'no_warnings': False,
@@ -139,77 +396,39 @@ class YouTubeAudioConverter:
                     }
                 }
                 
-                # Aggiungi cookies usando i metodi ufficiali di yt-dlp (solo per client che supportano cookies)
-                # Stesso processo unificato sia in locale che in produzione:
-                # 1. Prova --cookies-from-browser (yt-dlp gestisce automaticamente se non disponibile)
-                # 2. Usa anche --cookies file.txt se esiste (come fallback o in aggiunta)
+                # Cookies dal jar condiviso (solo per client che supportano cookies):
+                # niente cookiesfrombrowser/cookiefile, così yt-dlp non rilegge né riscrive nulla da disco
+                client_cookie_jar = None
                 if client in ['web', 'mweb']:
-                    # Lista browser da provare (stessa logica in locale e produzione)
-                    browsers_to_try = ['chrome', 'firefox', 'edge', 'safari', 'opera', 'brave']
-                    # Su Linux, aggiungi anche Chrome Flatpak
-                    if os.name != 'nt':
-                        browsers_to_try.insert(1, 'chrome:~/.var/app/com.google.Chrome/')
-                    
-                    # Prova sempre --cookies-from-browser (yt-dlp gestisce automaticamente se browser non disponibile)
-                    # yt-dlp Python API: cookiesfrombrowser è una tupla (browser,)
-                    ydl_opts['cookiesfrombrowser'] = (browsers_to_try[0],)
-                    print(f"✓ Using --cookies-from-browser {browsers_to_try[0]}")
-                    
-                    # Usa anche --cookies file.txt se esiste (come fallback o in aggiunta)
-                    if os.path.exists(self.cookies_path):
-                        ydl_opts['cookiefile'] = self.cookies_path
-                        file_size = os.path.getsize(self.cookies_path)
-                        print(f"✓ Using --cookies {self.cookies_path} ({file_size} bytes)")
-                    else:
-                        print(f"⚠ Cookies file not found at {self.cookies_path}")
-                        print(f"   Tip: Extract with: yt-dlp --cookies-from-browser chrome --cookies {self.cookies_path}")
+                    client_cookie_jar = cookie_jar
+                    print(f"✓ Using shared cookie jar ({len(cookie_jar)} cookies)")
                 
                 elif client in ['ios', 'android']:
                     # ios e android non supportano cookies
                     print(f"⚠ Client {client} does not support cookies, proceeding without")
                     print(f"   This may cause 'Sign in to confirm you're not a bot' errors")
                 
-                # Extract info first (validates URL and checks for playlists)
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(youtube_url, download=False)
-                
-                # Validate: reject playlists
-                if info.get('_type') == 'playlist':
-                    raise ValueError("Playlists are not supported. Use a single video URL.")
-                
-                # Handle single-entry playlists (YouTube sometimes returns this)
-                if 'entries' in info and info['entries']:
-                    entries = list(info['entries'])
-                    if len(entries) > 1:
-                        raise ValueError("Playlists are not supported. Use a single video URL.")
-                    if len(entries) == 1:
-                        info = entries[0]
-                
-                # Validate video ID
-                if not info.get('id'):
-                    raise ValueError("Unable to extract video information. Check that the URL is correct.")
-                
-                # Check if audio or video formats are available
-                formats = info.get('formats', [])
-                audio_formats = [f for f in formats if f.get('acodec') != 'none' and f.get('vcodec') == 'none']
-                video_formats = [f for f in formats if f.get('vcodec') != 'none']
-                
-                if not audio_formats and not get_info_only:
-                    if video_formats:
-                        # Se ci sono formati video, useremo quello e estraiamo l'audio dopo
-                        print(f"⚠ Warning: No pure audio formats found, will download video and extract audio")
-                    else:
-                        # Se non ci sono formati disponibili, questo client non funziona
-                        raise Exception("No downloadable formats available for this client")
+                if probed_info is not None:
+                    # Primo tentativo con le info del probe (usate una volta sola)
+                    info, probed_info = probed_info, None
+                    print(f"Reusing metadata from probe ({client} client)")
+                else:
+                    # Extract info first (validates URL and checks for playlists)
+                    with self._create_ydl(ydl_opts, client_cookie_jar) as ydl:
+                        info = ydl.extract_info(youtube_url, download=False)
+                    info = self._validate_info(info, get_info_only)
+                    info['_player_client'] = client
                 
                 # If only info is needed, return now
                 if get_info_only:
                     return None, info
                 
-                # Download the video
-                print(f"Downloading with {client} client...")
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(youtube_url, download=True)
+                # Download the video (dalle info già estratte, senza ripetere l'estrazione)
+                print(f"Downloading with {client} client (format: {format_selector})...")
+                download_stats['bytes'] = 0
+                started = time.perf_counter()
+                with self._create_ydl(ydl_opts, client_cookie_jar) as ydl:
+                    info = ydl.process_ie_result(info, download=True)
                     video_path = ydl.prepare_filename(info)
                 
                 # Handle different file extensions (yt-dlp may download with different extension)
@@ -226,10 +445,19 @@ class YouTubeAudioConverter:
                     raise FileNotFoundError("Video file not found after download")
                 
                 # Success!
-                print(f"✓ Successfully downloaded video using {client} client")
+                timings['download'] = round(time.perf_counter() - started, 4)
+                info['downloaded_bytes'] = download_stats['bytes']
+                info['timings'] = timings
+                print(f"✓ Successfully downloaded video using {client} client "
+                      f"(format {info.get('format_id')}, {download_stats['bytes']} bytes)")
                 return video_path, info
                 
             except Exception as e:
+                # Annullamento: niente fallback sugli altri client, pulizia immediata
+                if isinstance(e, ConversionCancelled) or (cancel_event is not None and cancel_event.is_set()):
+                    if not getattr(cancel_event, 'handed_over', False):
+                        self._remove_files(partial_files)
+                    raise cancellation(cancel_event) from e
                 error_msg = str(e)
                 print(f"⚠ Client {client} failed: {error_msg[:200]}")
                 last_error = e
@@ -248,6 +476,44 @@ class YouTubeAudioConverter:
             # Raise error with clear message
             self._raise_download_error(error_msg)
     
+    def _validate_info(self, info, get_info_only):
+        """
+        Controlla le info estratte da yt-dlp: niente playlist, ID presente, formati scaricabili.
+        
+        Returns:
+            dict: Info del singolo video (estratto da una playlist di un solo elemento)
+        """
+        # Validate: reject playlists
+        if info.get('_type') == 'playlist':
+            raise ValueError("Playlists are not supported. Use a single video URL.")
+        
+        # Handle single-entry playlists (YouTube sometimes returns this)
+        if 'entries' in info and info['entries']:
+            entries = list(info['entries'])
+            if len(entries) > 1:
+                raise ValueError("Playlists are not supported. Use a single video URL.")
+            if len(entries) == 1:
+                info = entries[0]
+        
+        # Validate video ID
+        if not info.get('id'):
+            raise ValueError("Unable to extract video information. Check that the URL is correct.")
+        
+        # Check if audio or video formats are available
+        formats = info.get('formats', [])
+        audio_formats = [f for f in formats if f.get('acodec') != 'none' and f.get('vcodec') == 'none']
+        video_formats = [f for f in formats if f.get('vcodec') != 'none']
+        
+        if not audio_formats and not get_info_only:
+            if video_formats:
+                # Se ci sono formati video, useremo quello e estraiamo l'audio dopo
+                print(f"⚠ Warning: No pure audio formats found, will download video and extract audio")
+            else:
+                # Se non ci sono formati disponibili, questo client non funziona
+                raise Exception("No downloadable formats available for this client")
+        
+        return info
+    
     def _raise_download_error(self, error_msg):
         """
         Raises appropriate exception with clear error message based on error type.
@@ -276,19 +542,32 @@ class YouTubeAudioConverter:
         else:
             raise Exception(f"YouTube download failed: {error_msg}. Please try again later or use a different video.")
     
-    def convert_to_audio(self, video_path, audio_format, output_path=None):
+    def convert_to_audio(self, video_path, audio_format, output_path=None, cancel_event=None,
+                         input_chunks=None, pcm_sink=None):
         """
         Converte il video in formato audio specificato
         
         Args:
-            video_path: Path del file video
+            video_path: Path del file video (ignorato se input_chunks è fornito)
             audio_format: Formato audio desiderato (mp3, wav, flac, ogg, m4a, opus)
-            output_path: Path di output (opzionale, generato automaticamente se None)
+            output_path: Path di output (opzionale, generato automaticamente se None;
+                         obbligatorio con input_chunks)
+            cancel_event: threading.Event; se impostato ffmpeg viene terminato
+                          e il file parziale rimosso (ConversionCancelled)
+            input_chunks: Iterabile di bytes passato a ffmpeg via stdin
+                          (es. upload in streaming, senza file di input su disco)
+            pcm_sink: Callable(bytes) che riceve, nello stesso passaggio di decodifica,
+                      uno stream WAV float32 (mono o stereo come la sorgente, a PCM_SAMPLE_RATE Hz)
+                      (es. WaveformAnalyzer.feed per picchi, loudness e analisi)
         
         Returns:
             str: Path del file audio convertito
         """
-        if not os.path.exists(video_path):
+        if input_chunks is not None:
+            if output_path is None:
+                raise ValueError("output_path è obbligatorio con input_chunks")
+            video_path = 'pipe:0'
+        elif not os.path.exists(video_path):
             raise FileNotFoundError(f"File video non trovato: {video_path}")
         
         # Genera path di output se non fornito
@@ -297,6 +576,9 @@ class YouTubeAudioConverter:
             # Pulisce il nome del file da caratteri problematici
             base_name = re.sub(r'[^\w\s-]', '', base_name).strip()
             output_path = os.path.join(self.temp_dir, f"{base_name}.{audio_format}")
+            # ffmpeg non può leggere e scrivere lo stesso file (es. sorgente .m4a -> m4a)
+            if os.path.abspath(output_path) == os.path.abspath(video_path):
+                output_path = os.path.join(self.temp_dir, f"{base_name}-audio.{audio_format}")
         
         # Mappa formati a codec ffmpeg
         format_codec_map = {
@@ -313,7 +595,7 @@ class YouTubeAudioConverter:
         
         codec, container = format_codec_map[audio_format]
         
-        # Comando ffmpeg per conversione
+        # Comando ffmpeg per conversione (i thread vengono fissati dal budget CPU)
         cmd = [
             'ffmpeg',
             '-i', video_path,
@@ -333,13 +615,24 @@ class YouTubeAudioConverter:
             cmd.insert(-1, '-ac')
             cmd.insert(-1, '2')  # Stereo
         
+        # Seconda uscita: PCM grezzo su stdout dalla stessa decodifica
+        if pcm_sink is not None:
+            cmd += self._pcm_output_args()
+        
         try:
-            result = subprocess.run(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=True
-            )
+            with self.cpu_budget.reserve(self.cpu_budget.encode_threads(audio_format)) as threads:
+                self._check_cancelled(cancel_event)
+                # -threads dopo -i e prima di ogni path di uscita: vale per l'encoder, non per il decoder
+                for output in (output_path, 'pipe:1') if pcm_sink is not None else (output_path,):
+                    position = cmd.index(output)
+                    cmd[position:position] = ['-threads', str(threads)]
+                stderr = self._run_ffmpeg(cmd, output_path, cancel_event, input_chunks, pcm_sink)
+            
+            if input_chunks is not None and b'partial file' in stderr:
+                # ffmpeg 7 con moov in fondo: "stream 0, offset ...: partial file", nessun frame
+                # decodificato e uscita con codice 0 (le versioni precedenti: 'moov atom not found')
+                self._remove_files([output_path])
+                raise ValueError(NOT_FASTSTART_MESSAGE)
             
             if not os.path.exists(output_path):
                 raise FileNotFoundError("File audio non creato dopo la conversione")
@@ -347,15 +640,149 @@ class YouTubeAudioConverter:
             return output_path
         
         except subprocess.CalledProcessError as e:
-            error_msg = e.stderr.decode('utf-8') if e.stderr else str(e)
+            error_msg = e.stderr.decode('utf-8', errors='replace') if e.stderr else str(e)
+            if input_chunks is not None and 'moov atom not found' in error_msg:
+                raise ValueError(NOT_FASTSTART_MESSAGE) from e
             raise Exception(f"Errore durante la conversione con ffmpeg: {error_msg}")
     
-    def analyze_audio(self, audio_path):
+    def _pcm_output_args(self):
+        """
+        Argomenti ffmpeg per un'uscita WAV float32 su stdout.
+        
+        Niente -ac: i canali della sorgente vengono mantenuti (multicanale ridotto a
+        stereo), così la loudness di un mono non viene misurata su un dual-mono.
+        Il WAV porta nell'header i canali effettivi per WaveformAnalyzer.
+        """
+        return [
+            '-vn',
+            '-acodec', 'pcm_f32le',
+            '-af', f'aformat=channel_layouts={PCM_CHANNEL_LAYOUTS}',
+            '-ar', str(PCM_SAMPLE_RATE),
+            '-f', 'wav',
+            'pipe:1'
+        ]
+    
+    def decode_pcm(self, audio_path, pcm_sink, cancel_event=None):
+        """
+        Decodifica un file audio esistente in PCM per pcm_sink, senza encode.
+        
+        Serve solo quando la conversione è già stata fatta (es. job ripreso dopo
+        un riavvio) e quindi il PCM non è arrivato durante convert_to_audio.
+        """
+        cmd = ['ffmpeg', '-i', audio_path] + self._pcm_output_args()
+        try:
+            with self.cpu_budget.reserve(1):
+                self._check_cancelled(cancel_event)
+                self._run_ffmpeg(cmd, None, cancel_event, pcm_sink=pcm_sink)
+        except subprocess.CalledProcessError as e:
+            error_msg = e.stderr.decode('utf-8') if e.stderr else str(e)
+            raise Exception(f"Errore durante la decodifica con ffmpeg: {error_msg}")
+    
+    def _run_ffmpeg(self, cmd, output_path, cancel_event=None, input_chunks=None, pcm_sink=None):
+        """
+        Esegue ffmpeg come processo figlio interrompibile.
+        
+        Args:
+            input_chunks: Iterabile di bytes scritto su stdin di ffmpeg (input 'pipe:0')
+            pcm_sink: Callable(bytes) che riceve quanto ffmpeg scrive su stdout ('pipe:1')
+        
+        Returns:
+            bytes: stderr di ffmpeg (avvisi anche con uscita senza errori)
+        
+        Raises:
+            subprocess.CalledProcessError: ffmpeg terminato con errore
+            ConversionCancelled: cancel_event impostato durante l'esecuzione
+        """
+        process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if input_chunks is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE if pcm_sink is not None else subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        # stderr (e stdout) letti in thread separati, così ffmpeg non si blocca a pipe piena
+        stderr_output = []
+        stderr_reader = threading.Thread(target=lambda: stderr_output.append(process.stderr.read()))
+        stderr_reader.daemon = True
+        stderr_reader.start()
+        
+        pcm_errors = []
+        
+        def read_pcm():
+            try:
+                for block in iter(lambda: process.stdout.read(256 * 1024), b''):
+                    pcm_sink(block)
+            except Exception as e:
+                # Continua a svuotare la pipe, l'errore viene sollevato a fine processo
+                pcm_errors.append(e)
+                for _ in iter(lambda: process.stdout.read(256 * 1024), b''):
+                    pass
+        
+        pcm_reader = None
+        if pcm_sink is not None:
+            pcm_reader = threading.Thread(target=read_pcm)
+            pcm_reader.daemon = True
+            pcm_reader.start()
+        
+        def abort():
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            if not getattr(cancel_event, 'handed_over', False):
+                self._remove_files([output_path])
+            raise cancellation(cancel_event)
+        
+        if input_chunks is not None:
+            try:
+                for chunk in input_chunks:
+                    if cancel_event is not None and cancel_event.is_set():
+                        abort()
+                    process.stdin.write(chunk)
+            except BrokenPipeError:
+                # ffmpeg è uscito prima della fine dell'input: l'errore arriva dal returncode
+                pass
+            except BaseException:
+                # Errore lato input (es. upload troppo grande): ffmpeg non deve restare appeso
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                self._remove_files([output_path])
+                raise
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+        
+        while True:
+            try:
+                process.wait(timeout=0.25)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_event is not None and cancel_event.is_set():
+                    abort()
+        
+        stderr_reader.join()
+        if pcm_reader is not None:
+            pcm_reader.join()
+        stderr = stderr_output[0] if stderr_output else b''
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, None, stderr)
+        if pcm_errors:
+            raise pcm_errors[0]
+        return stderr
+    
+    def analyze_audio(self, audio_path, cancel_event=None, samples=None):
         """
         Analizza l'audio per rilevare BPM e scala musicale
         
         Args:
             audio_path: Path del file audio da analizzare
+            cancel_event: threading.Event; se impostato l'analisi si ferma (ConversionCancelled)
+            samples: (y, sr) già decodificati (es. WaveformAnalyzer.head()); se forniti
+                     il file non viene decodificato di nuovo
         
         Returns:
             tuple: (bpm, scale) dove bpm è un int e scale è una stringa
@@ -363,54 +790,69 @@ class YouTubeAudioConverter:
         try:
             print(f"Analyzing audio for BPM and key detection...")
             
-            # Carica l'audio (usa solo i primi 30 secondi per velocità)
-            y, sr = librosa.load(audio_path, duration=30.0)
-            
-            # Rileva BPM
-            tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
-            # tempo può essere un array, prendi il primo valore o la media
-            if isinstance(tempo, np.ndarray):
-                tempo = float(tempo[0]) if len(tempo) > 0 else float(np.mean(tempo))
-            bpm = int(round(float(tempo)))
-            
-            # Rileva la tonalità/scala
-            # Usa chroma features per determinare la tonalità
-            chroma = librosa.feature.chroma_stft(y=y, sr=sr)
-            chroma_mean = np.mean(chroma, axis=1)
-            
-            # Nomi delle note
-            note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-            
-            # Trova la nota principale (quella con il valore più alto)
-            main_note_idx = np.argmax(chroma_mean)
-            main_note = note_names[main_note_idx]
-            
-            # Determina se è maggiore o minore
-            # Confronta le energie delle terze maggiori e minori
-            # Per semplicità, usiamo un'euristica basata sulla distribuzione cromatica
-            # Se la terza maggiore (4 semitoni) ha più energia, è maggiore
-            third_major_idx = (main_note_idx + 4) % 12
-            third_minor_idx = (main_note_idx + 3) % 12
-            
-            third_major_energy = chroma_mean[third_major_idx]
-            third_minor_energy = chroma_mean[third_minor_idx]
-            
-            if third_major_energy > third_minor_energy:
-                scale_type = "Major"
-            else:
-                scale_type = "Minor"
-            
-            scale = f"{main_note} {scale_type}"
-            
-            print(f"BPM detected: {bpm}, Key detected: {scale}")
-            
-            return bpm, scale
+            with self.cpu_budget.reserve(self.cpu_budget.ANALYSIS_TOKENS):
+                return self._analyze_audio(audio_path, cancel_event, samples)
         
+        except ConversionCancelled:
+            raise
         except Exception as e:
             print(f"Error during audio analysis: {e}")
             # On error, return default values
             return None, None
     
+    def _analyze_audio(self, audio_path, cancel_event=None, samples=None):
+        """Rilevamento BPM e scala vero e proprio (eseguito dentro il budget CPU)"""
+        self._check_cancelled(cancel_event)
+        
+        # Carica l'audio (usa solo i primi 30 secondi per velocità)
+        if samples is not None and len(samples[0]):
+            y, sr = samples
+        else:
+            y, sr = librosa.load(audio_path, duration=30.0)
+        self._check_cancelled(cancel_event)
+        
+        # Rileva BPM
+        tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
+        # tempo può essere un array, prendi il primo valore o la media
+        if isinstance(tempo, np.ndarray):
+            tempo = float(tempo[0]) if len(tempo) > 0 else float(np.mean(tempo))
+        bpm = int(round(float(tempo)))
+        
+        self._check_cancelled(cancel_event)
+        
+        # Rileva la tonalità/scala
+        # Usa chroma features per determinare la tonalità
+        chroma = librosa.feature.chroma_stft(y=y, sr=sr)
+        chroma_mean = np.mean(chroma, axis=1)
+        
+        # Nomi delle note
+        note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+        
+        # Trova la nota principale (quella con il valore più alto)
+        main_note_idx = np.argmax(chroma_mean)
+        main_note = note_names[main_note_idx]
+        
+        # Determina se è maggiore o minore
+        # Confronta le energie delle terze maggiori e minori
+        # Per semplicità, usiamo un'euristica basata sulla distribuzione cromatica
+        # Se la terza maggiore (4 semitoni) ha più energia, è maggiore
+        third_major_idx = (main_note_idx + 4) % 12
+        third_minor_idx = (main_note_idx + 3) % 12
+        
+        third_major_energy = chroma_mean[third_major_idx]
+        third_minor_energy = chroma_mean[third_minor_idx]
+        
+        if third_major_energy > third_minor_energy:
+            scale_type = "Major"
+        else:
+            scale_type = "Minor"
+        
+        scale = f"{main_note} {scale_type}"
+        
+        print(f"BPM detected: {bpm}, Key detected: {scale}")
+        
+        return bpm, scale
+    
     def sanitize_filename(self, filename):
         """Rimuove caratteri non validi dal nome del file"""
         # Rimuove caratteri problematici
@@ -503,7 +945,7 @@ class YouTubeAudioConverter:
         try:
             # Download video
             print(f"Download video da: {youtube_url}")
-            video_path, video_info = self.download_video(youtube_url)
+            video_path, video_info = self.download_video(youtube_url, audio_format=audio_format)
             
             # Estrae il titolo
             title = video_info.get('title', 'Track')
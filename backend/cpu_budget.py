@@ -0,0 +1,143 @@
+import os
+import threading
+from contextlib import contextmanager
+
+
+def detect_cpu_count():
+    """
+    Rileva i core effettivamente utilizzabili dal processo.
+
+    Tiene conto di (in ordine):
+    - variabile d'ambiente CPU_BUDGET (override esplicito)
+    - quota cgroup v2 (/sys/fs/cgroup/cpu.max) o v1 (cpu.cfs_quota_us)
+    - affinità CPU del processo
+
+    Returns:
+        int: Numero di core (almeno 1)
+    """
+    env_budget = os.environ.get('CPU_BUDGET')
+    if env_budget:
+        try:
+            return max(1, int(env_budget))
+        except ValueError:
+            print(f"⚠ Invalid CPU_BUDGET value: {env_budget}, ignoring")
+
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cores = os.cpu_count() or 1
+
+    quota = _read_cgroup_quota()
+    if quota:
+        cores = min(cores, quota)
+
+    return max(1, cores)
+
+
+def _read_cgroup_quota():
+    """Restituisce la quota CPU del cgroup arrotondata per eccesso, o None se assente"""
+    # cgroup v2: "<quota> <period>" oppure "max <period>"
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return max(1, -(-int(quota) // int(period)))
+        return None
+    except (OSError, ValueError):
+        pass
+
+    # cgroup v1: quota -1 = nessun limite
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read().strip())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read().strip())
+        if quota > 0 and period > 0:
+            return max(1, -(-quota // period))
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+class CPUBudget:
+    """
+    Budget condiviso di token CPU per encoding ffmpeg e analisi librosa.
+
+    Ogni token corrisponde a un core. Chi lavora chiede un certo numero di
+    token e ne riceve al massimo quanti sono liberi (almeno uno), aspettando
+    se il budget è esaurito. In questo modo encode e analisi concorrenti non
+    superano mai il numero di core disponibili.
+    """
+
+    # Thread dell'encoder ffmpeg per formato. libmp3lame, libvorbis, libopus, aac,
+    # flac e pcm sono single-thread: riservare di più lascerebbe core inutilizzati.
+    # Da alzare solo per encoder che usano davvero più thread.
+    ENCODE_THREADS = {
+        'mp3': 1,
+        'wav': 1,
+        'flac': 1,
+        'ogg': 1,
+        'm4a': 1,
+        'opus': 1,
+    }
+
+    # Token usati dall'analisi BPM/tonalità (converter.py limita a tanti thread anche BLAS/OpenMP/numba)
+    ANALYSIS_TOKENS = 1
+
+    def __init__(self, total=None):
+        """
+        Args:
+            total: Numero totale di token (default: core rilevati da detect_cpu_count)
+        """
+        self.total = total or detect_cpu_count()
+        self._in_use = 0
+        self._waiting = 0
+        self._condition = threading.Condition()
+
+    def encode_threads(self, audio_format):
+        """Thread desiderati per un encode nel formato indicato, limitati dal budget totale"""
+        return min(self.ENCODE_THREADS.get(audio_format, 1), self.total)
+
+    @contextmanager
+    def reserve(self, tokens=1):
+        """
+        Riserva token dal budget per la durata del blocco with.
+
+        Args:
+            tokens: Token desiderati
+
+        Yields:
+            int: Token effettivamente concessi (1 <= concessi <= tokens)
+        """
+        tokens = max(1, min(tokens, self.total))
+        with self._condition:
+            self._waiting += 1
+            try:
+                while self._in_use >= self.total:
+                    self._condition.wait()
+            finally:
+                self._waiting -= 1
+            granted = min(tokens, self.total - self._in_use)
+            self._in_use += granted
+        try:
+            yield granted
+        finally:
+            with self._condition:
+                self._in_use -= granted
+                self._condition.notify_all()
+
+    def utilization(self):
+        """
+        Restituisce l'utilizzo corrente del budget.
+
+        Returns:
+            dict: total, in_use, waiting, utilization (0.0 - 1.0)
+        """
+        with self._condition:
+            return {
+                'total': self.total,
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'utilization': round(self._in_use / self.total, 3),
+            }
@@ -0,0 +1,348 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class SQLiteJobQueue:
+    """
+    Coda di job condivisa su SQLite, per separare il processo API dai worker.
+
+    Non richiede servizi esterni, ma API e worker devono stare sulla stessa macchina:
+    la modalità WAL si coordina con memoria condivisa e lock locali e non funziona
+    su filesystem di rete (NFS, volumi condivisi tra nodi). Oltre alla coda contiene lo stato
+    dei task mostrato da /status, con la stessa interfaccia di
+    task_store.LocalTaskStore (create, get, update, touch, remove, active, __len__).
+
+    Ciclo di vita di una riga nella tabella jobs (colonna queue_status):
+        new -> queued (enqueue, dopo il probe) -> running (claim) -> done
+
+    Un worker che prende un job ottiene un lease di durata limitata e lo rinnova
+    con heartbeat. Se il worker muore il lease scade e il job torna prendibile da
+    un altro worker (fino a MAX_ATTEMPTS tentativi), riprendendo dalle fasi
+    già completate registrate con checkpoint(). I checkpoint (path dei file di
+    lavoro) stanno in una colonna a parte: non fanno parte dello stato di /status.
+
+    L'ordine di estrazione è lo stesso di scheduler.JobScheduler: virtual finish
+    time minimo (shortest-job-first con aging e fair queuing per client), con i
+    tempi virtuali salvati nel database e quindi condivisi tra i worker.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, path, aging_rate=None):
+        """
+        Args:
+            path: Path del database SQLite (creato se non esiste)
+            aging_rate: Secondi di costo condonati per ogni secondo di attesa
+                        (default: env SCHEDULER_AGING_RATE o 60)
+        """
+        self.path = path
+        self.aging_rate = aging_rate if aging_rate is not None else float(os.environ.get('SCHEDULER_AGING_RATE', 60))
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._transaction() as db:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    task_id TEXT PRIMARY KEY,
+                    client_id TEXT,
+                    payload TEXT,
+                    state TEXT NOT NULL,
+                    queue_status TEXT NOT NULL DEFAULT 'new',
+                    cost REAL,
+                    enqueued_at REAL,
+                    worker_id TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    last_poll REAL,
+                    finished_at REAL,
+                    checkpoint TEXT
+                )
+            ''')
+            # Database creati prima delle colonne last_poll, finished_at e checkpoint
+            columns = [row[1] for row in db.execute('PRAGMA table_info(jobs)')]
+            if 'last_poll' not in columns:
+                db.execute('ALTER TABLE jobs ADD COLUMN last_poll REAL')
+            if 'finished_at' not in columns:
+                db.execute('ALTER TABLE jobs ADD COLUMN finished_at REAL')
+                # I job già chiusi scadono a partire da adesso
+                db.execute("UPDATE jobs SET finished_at = ? WHERE queue_status = 'done'", (time.time(),))
+            if 'checkpoint' not in columns:
+                db.execute('ALTER TABLE jobs ADD COLUMN checkpoint TEXT')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_queue_status ON jobs (queue_status)')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS fairness (
+                    client_id TEXT PRIMARY KEY,
+                    vtime REAL NOT NULL
+                )
+            ''')
+
+    def _connection(self):
+        """Connessione SQLite per il thread corrente"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    # --- Stato dei task (interfaccia comune con LocalTaskStore) ---
+
+    def create(self, task_id, state):
+        """Registra un nuovo task con lo stato iniziale (non ancora in coda)"""
+        state = dict(state)
+        last_poll = state.pop('last_poll') if 'last_poll' in state else time.time()
+        with self._transaction() as db:
+            db.execute('INSERT OR REPLACE INTO jobs (task_id, state, last_poll) VALUES (?, ?, ?)',
+                       (task_id, json.dumps(dict(state, version=1)), last_poll))
+
+    def get(self, task_id):
+        """
+        Returns:
+            dict | None: Stato del task, None se non esiste
+        """
+        row = self._connection().execute('SELECT state FROM jobs WHERE task_id = ?', (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, task_id, **fields):
+        """
+        Aggiorna i campi dello stato del task.
+
+        Returns:
+            bool: False se il task non esiste
+        """
+        with self._transaction() as db:
+            return self._update_state(db, task_id, fields)
+
+    def _update_state(self, db, task_id, fields):
+        row = db.execute('SELECT state, cancel_requested FROM jobs WHERE task_id = ?', (task_id,)).fetchone()
+        if row is None:
+            return False
+        state = json.loads(row[0])
+        if row[1] and state.get('status') == 'cancelled':
+            # Un task annullato resta 'cancelled': il worker può scrivere ancora per un po' prima di fermarsi
+            fields = {key: value for key, value in fields.items() if key not in ('status', 'progress', 'message')}
+        if not fields:
+            return True
+        state.update(fields)
+        state['version'] = state.get('version', 0) + 1
+        db.execute('UPDATE jobs SET state = ? WHERE task_id = ?', (json.dumps(state), task_id))
+        return True
+
+    def touch(self, task_id):
+        """
+        Registra un polling di /status (usato dal watchdog dei task abbandonati).
+
+        Come in LocalTaskStore last_poll sta fuori dallo stato: un solo UPDATE in
+        autocommit, senza rileggere il JSON e senza cambiare version.
+
+        Returns:
+            bool: False se il task non esiste
+        """
+        cursor = self._connection().execute('UPDATE jobs SET last_poll = ? WHERE task_id = ?',
+                                            (time.time(), task_id))
+        return cursor.rowcount > 0
+
+    def remove(self, task_id):
+        """Dimentica un task (es. risultato scaduto)"""
+        with self._transaction() as db:
+            db.execute('DELETE FROM jobs WHERE task_id = ?', (task_id,))
+
+    def expire(self, before):
+        """
+        Toglie dalla tabella i job chiusi prima di before (timestamp).
+
+        Returns:
+            dict: task_id -> stato dei job rimossi (per cancellarne i file)
+        """
+        with self._transaction() as db:
+            rows = db.execute("SELECT task_id, state FROM jobs WHERE queue_status = 'done' AND finished_at < ?",
+                              (before,)).fetchall()
+            db.execute("DELETE FROM jobs WHERE queue_status = 'done' AND finished_at < ?", (before,))
+        return {task_id: json.loads(state) for task_id, state in rows}
+
+    def active(self, statuses):
+        """
+        Returns:
+            list: (task_id, stato con last_poll) dei task non terminati con status in statuses
+        """
+        rows = self._connection().execute(
+            "SELECT task_id, state, last_poll FROM jobs WHERE queue_status != 'done'"
+        ).fetchall()
+        result = []
+        for task_id, state, last_poll in rows:
+            state = json.loads(state)
+            state['last_poll'] = last_poll
+            if state.get('status') in statuses:
+                result.append((task_id, state))
+        return result
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    # --- Coda ---
+
+    def enqueue(self, task_id, client_id, payload, cost):
+        """Mette in coda un task già creato e ammesso (probe completato)"""
+        with self._transaction() as db:
+            db.execute('''
+                UPDATE jobs SET client_id = ?, payload = ?, cost = ?, enqueued_at = ?, queue_status = 'queued'
+                WHERE task_id = ? AND queue_status = 'new' AND cancel_requested = 0
+            ''', (client_id, json.dumps(payload), cost, time.time(), task_id))
+
+    def claim(self, worker_id, lease_seconds):
+        """
+        Prende il prossimo job: in coda, oppure in esecuzione con lease scaduto.
+
+        Returns:
+            tuple | None: (task_id, payload, state) oppure None se non c'è lavoro;
+                          state include i checkpoint delle fasi già completate
+        """
+        now = time.time()
+        with self._transaction() as db:
+            # Job annullati il cui worker è morto: non vanno ripresi
+            db.execute('''
+                UPDATE jobs SET queue_status = 'done', finished_at = ?
+                WHERE queue_status = 'running' AND cancel_requested = 1 AND lease_until < ?
+            ''', (now, now))
+            rows = db.execute('''
+                SELECT task_id, client_id, cost, enqueued_at, attempts FROM jobs
+                WHERE cancel_requested = 0
+                  AND (queue_status = 'queued' OR (queue_status = 'running' AND lease_until < ?))
+            ''', (now,)).fetchall()
+            if not rows:
+                return None
+
+            vtimes = dict(db.execute('SELECT client_id, vtime FROM fairness').fetchall())
+            global_vtime = vtimes.get('', 0.0)
+
+            best = None
+            for task_id, client_id, cost, enqueued_at, attempts in rows:
+                if attempts >= self.MAX_ATTEMPTS:
+                    db.execute("UPDATE jobs SET queue_status = 'done', finished_at = ? WHERE task_id = ?",
+                               (now, task_id))
+                    self._update_state(db, task_id, {
+                        'status': 'error',
+                        'progress': 0,
+                        'message': 'Error during conversion',
+                        'error': f'Job failed after {attempts} worker attempts',
+                        'file': None
+                    })
+                    continue
+                start = max(global_vtime, vtimes.get(client_id, 0.0))
+                finish = start + max(0.0, cost - self.aging_rate * (now - enqueued_at))
+                if best is None or finish < best[0]:
+                    best = (finish, start, task_id, client_id, cost)
+            if best is None:
+                return None
+
+            _, start, task_id, client_id, cost = best
+            db.execute('INSERT OR REPLACE INTO fairness (client_id, vtime) VALUES (?, ?)', ('', start))
+            db.execute('INSERT OR REPLACE INTO fairness (client_id, vtime) VALUES (?, ?)', (client_id, start + cost))
+            db.execute("DELETE FROM fairness WHERE client_id != '' AND vtime <= ?", (start,))
+            db.execute('''
+                UPDATE jobs SET queue_status = 'running', worker_id = ?, lease_until = ?, attempts = attempts + 1
+                WHERE task_id = ?
+            ''', (worker_id, now + lease_seconds, task_id))
+            payload, state, checkpoint = db.execute('SELECT payload, state, checkpoint FROM jobs WHERE task_id = ?',
+                                                    (task_id,)).fetchone()
+            return task_id, json.loads(payload), dict(json.loads(state), **json.loads(checkpoint or '{}'))
+
+    def checkpoint(self, task_id, **fields):
+        """
+        Registra una fase completata (es. video_path, audio_path) per la ripresa del job.
+
+        Finisce nello stato restituito da claim(), non in quello restituito da get().
+        """
+        with self._transaction() as db:
+            row = db.execute('SELECT checkpoint FROM jobs WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None:
+                return
+            checkpoint = json.loads(row[0]) if row[0] else {}
+            checkpoint.update(fields)
+            db.execute('UPDATE jobs SET checkpoint = ? WHERE task_id = ?', (json.dumps(checkpoint), task_id))
+
+    def heartbeat(self, task_id, worker_id, lease_seconds):
+        """
+        Rinnova il lease di un job in esecuzione.
+
+        Returns:
+            str: 'ok', 'cancelled' (annullamento richiesto) o 'lost' (lease passato a un altro worker)
+        """
+        with self._transaction() as db:
+            row = db.execute('SELECT worker_id, queue_status, cancel_requested FROM jobs WHERE task_id = ?',
+                             (task_id,)).fetchone()
+            if row is None or row[0] != worker_id or row[1] != 'running':
+                return 'lost'
+            db.execute('UPDATE jobs SET lease_until = ? WHERE task_id = ?', (time.time() + lease_seconds, task_id))
+            return 'cancelled' if row[2] else 'ok'
+
+    def finish(self, task_id, worker_id, **fields):
+        """
+        Chiude un job e ne aggiorna lo stato, solo se il lease è ancora del worker.
+
+        Returns:
+            bool: False se il job nel frattempo è passato a un altro worker
+        """
+        with self._transaction() as db:
+            row = db.execute('SELECT worker_id FROM jobs WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None or row[0] != worker_id:
+                return False
+            db.execute("UPDATE jobs SET queue_status = 'done', lease_until = NULL, finished_at = ? WHERE task_id = ?",
+                       (time.time(), task_id))
+            self._update_state(db, task_id, fields)
+            return True
+
+    def request_cancel(self, task_id, **fields):
+        """
+        Chiede l'annullamento: i job in coda escono subito, quelli in esecuzione si fermano
+        appena il worker controlla cancelled(). fields (es. status='cancelled') viene scritto
+        nello stato nella stessa transazione, così nessun aggiornamento del worker lo sovrascrive.
+        """
+        with self._transaction() as db:
+            self._update_state(db, task_id, fields)
+            db.execute('UPDATE jobs SET cancel_requested = 1 WHERE task_id = ?', (task_id,))
+            db.execute('''
+                UPDATE jobs SET queue_status = 'done', finished_at = ?
+                WHERE task_id = ? AND queue_status IN ('new', 'queued')
+            ''', (time.time(), task_id))
+
+    def cancelled(self, task_ids):
+        """
+        Returns:
+            set: task_id, tra quelli indicati, di cui è stato chiesto l'annullamento
+        """
+        if not task_ids:
+            return set()
+        placeholders = ','.join('?' * len(task_ids))
+        rows = self._connection().execute(
+            f'SELECT task_id FROM jobs WHERE cancel_requested = 1 AND task_id IN ({placeholders})',
+            list(task_ids)
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def stats(self):
+        """
+        Returns:
+            dict: job queued e running nella coda condivisa
+        """
+        rows = self._connection().execute(
+            "SELECT queue_status, COUNT(*) FROM jobs WHERE queue_status IN ('queued', 'running') GROUP BY queue_status"
+        ).fetchall()
+        counts = dict(rows)
+        return {'queued': counts.get('queued', 0), 'running': counts.get('running', 0)}
@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+
+
+class JobJournal:
+    """
+    Journal append-only dei job, su file JSON lines.
+
+    Ogni riga è un evento {'task_id', 'event', 'ts', ...campi}. Gli eventi di uno
+    stesso task vengono fusi in ordine in fase di replay, così all'avvio si sa
+    a che punto era arrivato ogni job (submitted, queued, downloaded, converted)
+    e quali sono terminati (completed, error, cancelled).
+
+    Le scritture sono seguite da fsync: una riga scritta sopravvive a un crash
+    o a un riavvio del processo. Una riga troncata (crash a metà scrittura)
+    viene ignorata al replay.
+    """
+
+    FINAL_EVENTS = ('completed', 'error', 'cancelled')
+
+    def __init__(self, path):
+        """
+        Args:
+            path: Path del file journal (creato se non esiste)
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._terminate_partial_line()
+
+    def _terminate_partial_line(self):
+        """Chiude una riga troncata da un crash, così il prossimo evento non ci finisce attaccato"""
+        if self._file.tell() == 0:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                self._file.write('\n')
+                self._file.flush()
+
+    def append(self, task_id, event, **fields):
+        """Registra un evento per il task in modo durevole"""
+        record = {'task_id': task_id, 'event': event, 'ts': time.time()}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def replay(self):
+        """
+        Rilegge il journal e fonde gli eventi per task.
+
+        Returns:
+            dict: task_id -> stato fuso (campi di tutti gli eventi, 'event' = ultimo evento)
+        """
+        with self._lock:
+            return self._read()
+
+    def _read(self):
+        jobs = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    jobs.setdefault(record['task_id'], {}).update(record)
+        except FileNotFoundError:
+            pass
+        return jobs
+
+    def expire(self, before):
+        """
+        Toglie dal journal i task terminati prima di before (timestamp) e lo compatta.
+
+        Lettura e riscrittura avvengono sotto lo stesso lock: gli eventi registrati
+        nel frattempo non vanno persi.
+
+        Returns:
+            dict: task_id -> stato fuso dei task rimossi (per cancellarne i file)
+        """
+        with self._lock:
+            jobs = self._read()
+            expired = {task_id: job for task_id, job in jobs.items()
+                       if job.get('event') in self.FINAL_EVENTS and job.get('ts', 0) < before}
+            if expired:
+                self._rewrite({task_id: job for task_id, job in jobs.items() if task_id not in expired})
+        return expired
+
+    def compact(self, keep):
+        """
+        Riscrive il journal tenendo solo gli stati fusi indicati (un record per task).
+
+        La sostituzione è atomica (file temporaneo + os.replace).
+
+        Args:
+            keep: dict task_id -> stato fuso (come restituito da replay)
+        """
+        with self._lock:
+            self._rewrite(keep)
+
+    def _rewrite(self, keep):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in keep.values():
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
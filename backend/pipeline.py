@@ -0,0 +1,173 @@
+import os
+import shutil
+import time
+from converter import ConversionCancelled, LeaseLost, cancellation
+from waveform import WaveformAnalyzer
+
+
+def run_conversion(converter, task_id, youtube_url, audio_format, output_dir, report, checkpoint,
+                   cancel_event, resume=None, probed_info=None):
+    """
+    Pipeline completa di un job: download, conversione, analisi, rinomina.
+
+    La conversione decodifica la sorgente una sola volta: lo stesso PCM alimenta
+    l'encoder, i picchi del waveform, la loudness integrata e l'analisi BPM/tonalità.
+
+    Usata sia dal processo API (coda locale) sia da worker.py (coda condivisa):
+    chi la chiama decide dove finiscono gli aggiornamenti di stato e i checkpoint.
+
+    Args:
+        converter: YouTubeAudioConverter
+        task_id: ID del task (usato per i nomi stabili dei file di lavoro)
+        youtube_url: URL del video
+        audio_format: Formato audio desiderato
+        output_dir: Directory dei file finali (servita da /download)
+        report: Callable(**fields) che aggiorna lo stato mostrato da /status
+        checkpoint: Callable(event, **fields) che registra in modo durevole una fase completata
+        cancel_event: threading.Event per annullare download, ffmpeg e analisi
+        resume: Stato salvato di un job ripreso; le fasi già completate
+                (download, encode) non vengono ripetute
+        probed_info: Info del probe fatto dallo scheduler nello stesso processo;
+                     il download le riusa invece di ripetere l'estrazione
+
+    Returns:
+        dict: file (path del file audio finale), peaks (path del file .peaks),
+              loudness_lufs, bpm, key
+
+    Raises:
+        ConversionCancelled: cancel_event impostato
+        LeaseLost: job passato a un altro worker (cancel_event.hand_over())
+        Exception: errore di download, conversione o analisi
+
+        I file di lavoro del job sono già rimossi, tranne con LeaseLost: li sta
+        usando il worker che ha ripreso il job.
+    """
+    resume = resume or {}
+    video_path = None
+    temp_audio_path = None
+    peaks_path = None
+    waveform = WaveformAnalyzer()
+    try:
+        if cancel_event.is_set():
+            raise cancellation(cancel_event)
+        print(f"[convert_task] Starting conversion for task_id: {task_id}")
+        report(status='downloading', progress=10, message='Starting download...')
+
+        timings = {}
+        title = resume.get('title', 'Track')
+
+        # Fasi già completate prima di un riavvio
+        if resume.get('audio_path') and os.path.exists(resume['audio_path']):
+            temp_audio_path = resume['audio_path']
+            video_path = resume.get('video_path')
+            print(f"[convert_task] Task {task_id} resumed after encode, skipping download and conversion")
+        elif resume.get('video_path') and os.path.exists(resume['video_path']):
+            video_path = resume['video_path']
+            print(f"[convert_task] Task {task_id} resumed after download, skipping download")
+
+        if video_path is None and temp_audio_path is None:
+            # Download video (path stabile per job: dopo un riavvio yt-dlp riprende dal file .part)
+            report(progress=20, message='Downloading video...')
+            video_path, video_info = converter.download_video(youtube_url, audio_format=audio_format,
+                                                              cancel_event=cancel_event,
+                                                              output_name=f"job-{task_id}",
+                                                              probed_info=probed_info)
+            timings.update(video_info.get('timings', {}))
+            title = video_info.get('title', 'Track')
+            checkpoint('downloaded', video_path=video_path, title=title)
+
+            report(progress=40, message='Download completed',
+                   downloaded_bytes=video_info.get('downloaded_bytes', 0), timings=dict(timings))
+            cancel_event.wait(0.5)  # Small pause to show message
+
+        if temp_audio_path is None:
+            # Convert to audio
+            report(progress=50, message='Converting to ' + audio_format.upper() + '...')
+            started = time.perf_counter()
+            temp_audio_path = converter.convert_to_audio(
+                video_path, audio_format,
+                output_path=os.path.join(converter.temp_dir, f"job-{task_id}-audio.{audio_format}"),
+                cancel_event=cancel_event,
+                pcm_sink=waveform.feed
+            )
+            timings['convert'] = round(time.perf_counter() - started, 4)
+            checkpoint('converted', audio_path=temp_audio_path)
+
+            report(progress=60, message='Conversion completed', timings=dict(timings))
+            cancel_event.wait(0.5)
+        else:
+            # Encode già fatto prima di un riavvio: serve comunque il PCM per waveform e analisi
+            converter.decode_pcm(temp_audio_path, waveform.feed, cancel_event=cancel_event)
+
+        # Audio analysis
+        report(progress=70, message='Analyzing track: BPM & key detection...')
+        started = time.perf_counter()
+        bpm, scale = converter.analyze_audio(temp_audio_path, cancel_event=cancel_event, samples=waveform.head())
+        loudness = waveform.integrated_loudness()
+        peaks_path = os.path.join(output_dir, f"{task_id}.peaks")
+        waveform.write_peaks(peaks_path)
+        timings['analysis'] = round(time.perf_counter() - started, 4)
+
+        report(progress=85, message='Analysis completed', timings=dict(timings))
+        cancel_event.wait(0.5)
+        if cancel_event.is_set():
+            raise cancellation(cancel_event)
+
+        # Genera nome file e sposta nella directory di output
+        custom_filename = converter.generate_filename(title, bpm, scale, audio_format)
+        final_output_path = os.path.join(output_dir, custom_filename)
+
+        if os.path.exists(temp_audio_path):
+            if os.path.exists(final_output_path):
+                os.remove(final_output_path)
+            # shutil.move: la directory di output può essere su un altro filesystem (volume condiviso)
+            shutil.move(temp_audio_path, final_output_path)
+
+        # Pulisce file video temporaneo
+        if video_path and os.path.exists(video_path):
+            try:
+                os.remove(video_path)
+            except:
+                pass
+
+        return {
+            'file': final_output_path,
+            'peaks': peaks_path,
+            'loudness_lufs': loudness,
+            'bpm': bpm,
+            'key': scale
+        }
+
+    except LeaseLost:
+        print(f"[convert_task] Task {task_id} taken over by another worker, leaving its files in place")
+        raise
+    except ConversionCancelled:
+        # Libera subito disco e capacità: rimuove i file parziali
+        print(f"[convert_task] Task {task_id} cancelled, cleaning up")
+        remove_work_files(converter.temp_dir, task_id, peaks_path)
+        raise
+    except Exception:
+        # Un job fallito non viene ripreso: i suoi file di lavoro non servono più
+        # (a meno che nel frattempo non sia passato a un altro worker)
+        if not getattr(cancel_event, 'handed_over', False):
+            remove_work_files(converter.temp_dir, task_id, peaks_path)
+        raise
+
+
+def remove_work_files(work_dir, task_id, peaks_path=None):
+    """
+    Rimuove i file di lavoro di un job (job-<task_id>*: download anche parziali, encode)
+    e il suo file .peaks.
+    """
+    prefix = f"job-{task_id}"
+    try:
+        paths = [os.path.join(work_dir, name) for name in os.listdir(work_dir) if name.startswith(prefix)]
+    except OSError:
+        paths = []
+    if peaks_path:
+        paths.append(peaks_path)
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,60 @@
+import os
+import time
+
+
+# Per quanto restano disponibili i risultati (file audio, .peaks, record nel journal/coda)
+# e i file di lavoro orfani. 0 = nessuna pulizia.
+RESULT_RETENTION_SECONDS = float(os.environ.get('RESULT_RETENTION_HOURS', 24)) * 3600
+
+# Ogni quanto viene eseguita la pulizia
+RETENTION_CHECK_INTERVAL = 600
+
+# File di lavoro per task: download ed encode (job-<task_id>...) e upload (upload-<task_id>...)
+WORK_FILE_PREFIXES = ('job-', 'upload-')
+
+# Lunghezza di un task_id (uuid4 in forma testuale)
+TASK_ID_LENGTH = 36
+
+
+def remove_result_files(state, output_dir):
+    """Rimuove file audio finale e .peaks di un task (cercati in output_dir, come /download)"""
+    for key in ('file', 'peaks'):
+        if not state.get(key):
+            continue
+        path = os.path.join(output_dir, os.path.basename(state[key]))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def purge_work_files(directory, max_age, active_task_ids):
+    """
+    Rimuove i file di lavoro (job-*, upload-*) più vecchi di max_age secondi.
+
+    I file dei task in active_task_ids restano sempre, anche se vecchi (es. download
+    parziale di un job ripreso dopo un riavvio e ancora in coda).
+
+    Returns:
+        int: File rimossi
+    """
+    now = time.time()
+    removed = 0
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+    for name in names:
+        prefix = next((p for p in WORK_FILE_PREFIXES if name.startswith(p)), None)
+        if prefix is None:
+            continue
+        if name[len(prefix):len(prefix) + TASK_ID_LENGTH] in active_task_ids:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.path.isfile(path) and now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
@@ -0,0 +1,203 @@
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobRejected(ValueError):
+    """Job rifiutato in fase di ammissione (es. durata oltre il massimo consentito)"""
+    pass
+
+
+class ScheduledJob:
+    """Job in coda con il suo costo stimato"""
+
+    def __init__(self, task_id, client_id, run, cost, payload=None):
+        self.task_id = task_id
+        self.client_id = client_id
+        self.run = run
+        self.cost = cost
+        self.payload = payload
+        self.enqueued_at = time.monotonic()
+
+
+class JobScheduler:
+    """
+    Scheduler shortest-job-first con aging e fair queuing per client.
+
+    Ogni job passa prima da uno step di metadati (probe) che ne stima il costo
+    (durata del video). I job sono tenuti in una coda per client (IP o API key)
+    e il prossimo job da eseguire è quello con il virtual finish time più basso:
+
+        finish = max(V, vtime[client]) + max(0, cost - aging_rate * attesa)
+
+    - job corti hanno finish più basso (SJF)
+    - l'attesa riduce il costo effettivo, quindi un job lungo non aspetta per sempre (aging)
+    - ogni job eseguito fa avanzare vtime[client] del suo costo, quindi un client che
+      manda molti job pesanti passa dietro agli altri (fair queuing)
+    """
+
+    # Costo (secondi di audio) usato quando il probe non restituisce durata né dimensione
+    DEFAULT_COST = 600.0
+
+    def __init__(self, workers=None, aging_rate=None, max_duration=None, probe_workers=2, dispatch=None):
+        """
+        Args:
+            workers: Job eseguiti in parallelo (default: env MAX_CONCURRENT_JOBS o 2)
+            aging_rate: Secondi di costo condonati per ogni secondo di attesa
+                        (default: env SCHEDULER_AGING_RATE o 60)
+            max_duration: Durata massima accettata in secondi, 0/None = nessun limite
+                          (default: env MAX_DURATION_SECONDS)
+            probe_workers: Thread dedicati allo step di metadati
+            dispatch: Callable(ScheduledJob) che riceve i job ammessi al posto della
+                      coda locale (es. coda condivisa consumata da worker.py)
+        """
+        if workers is None:
+            workers = int(os.environ.get('MAX_CONCURRENT_JOBS', 2))
+        self.workers = workers
+        self.dispatch = dispatch
+        self.aging_rate = aging_rate if aging_rate is not None else float(os.environ.get('SCHEDULER_AGING_RATE', 60))
+        if max_duration is None:
+            max_duration = int(os.environ.get('MAX_DURATION_SECONDS', 0))
+        self.max_duration = max_duration or None
+
+        self._queues = {}
+        self._client_vtime = {}
+        self._vtime = 0.0
+        self._running = 0
+        self._condition = threading.Condition()
+
+        self._probe_pool = ThreadPoolExecutor(max_workers=probe_workers, thread_name_prefix='probe')
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'job-worker-{i}')
+            thread.daemon = True
+            thread.start()
+
+    @classmethod
+    def estimate_cost(cls, info):
+        """
+        Stima il costo di un job dai metadati yt-dlp.
+
+        Args:
+            info: Dizionario info restituito da download_video(get_info_only=True)
+
+        Returns:
+            float: Costo stimato (secondi di audio)
+        """
+        duration = info.get('duration')
+        if duration:
+            return float(duration)
+        filesize = info.get('filesize') or info.get('filesize_approx')
+        if filesize:
+            # ~128 kbps
+            return filesize / 16000.0
+        return cls.DEFAULT_COST
+
+    def submit(self, task_id, client_id, probe, run, on_error, payload=None):
+        """
+        Ammette un job: esegue il probe dei metadati e poi lo mette in coda.
+
+        Args:
+            task_id: ID del task
+            client_id: Identificativo del client (IP o API key) per il fair queuing
+            probe: Callable senza argomenti che restituisce il dizionario info
+            run: Callable senza argomenti che esegue il job
+            on_error: Callable(task_id, exception) chiamato se probe o ammissione falliscono
+            payload: Dati serializzabili del job, per il dispatch su una coda condivisa
+        """
+        def admit():
+            try:
+                info = probe()
+                duration = info.get('duration')
+                if self.max_duration and duration and duration > self.max_duration:
+                    raise JobRejected(
+                        f"Video too long ({int(duration)}s). Maximum allowed duration is {self.max_duration}s."
+                    )
+                job = ScheduledJob(task_id, client_id, run, self.estimate_cost(info), payload)
+                if self.dispatch is not None:
+                    self.dispatch(job)
+                else:
+                    self.enqueue(job)
+            except Exception as e:
+                on_error(task_id, e)
+
+        self._probe_pool.submit(admit)
+
+    def enqueue(self, job):
+        """Mette in coda un job già ammesso"""
+        with self._condition:
+            self._queues.setdefault(job.client_id, []).append(job)
+            self._condition.notify()
+
+    def cancel(self, task_id):
+        """
+        Rimuove dalla coda un job non ancora partito.
+
+        Returns:
+            bool: True se il job era in coda ed è stato rimosso
+        """
+        with self._condition:
+            for client_id, queue in self._queues.items():
+                for job in queue:
+                    if job.task_id == task_id:
+                        queue.remove(job)
+                        if not queue:
+                            del self._queues[client_id]
+                        return True
+        return False
+
+    def _pop_next(self):
+        """Estrae il job con virtual finish time minimo (da chiamare con il lock)"""
+        now = time.monotonic()
+        best = None
+        for client_id, queue in self._queues.items():
+            start = max(self._vtime, self._client_vtime.get(client_id, 0.0))
+            for job in queue:
+                finish = start + max(0.0, job.cost - self.aging_rate * (now - job.enqueued_at))
+                if best is None or finish < best[0]:
+                    best = (finish, start, job)
+
+        _, start, job = best
+        queue = self._queues[job.client_id]
+        queue.remove(job)
+        if not queue:
+            del self._queues[job.client_id]
+        self._vtime = start
+        self._client_vtime[job.client_id] = start + job.cost
+
+        # I client senza job in coda e già raggiunti dal tempo virtuale non servono più
+        for client_id in [c for c, v in self._client_vtime.items() if v <= self._vtime and c not in self._queues]:
+            del self._client_vtime[client_id]
+        return job
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                while not self._queues:
+                    self._condition.wait()
+                job = self._pop_next()
+                self._running += 1
+            try:
+                job.run()
+            except Exception as e:
+                print(f"Error in scheduled job {job.task_id}: {e}")
+                print(traceback.format_exc())
+            finally:
+                with self._condition:
+                    self._running -= 1
+
+    def stats(self):
+        """
+        Restituisce lo stato corrente della coda.
+
+        Returns:
+            dict: workers, running, queued, clients_queued
+        """
+        with self._condition:
+            return {
+                'workers': self.workers,
+                'running': self._running,
+                'queued': sum(len(q) for q in self._queues.values()),
+                'clients_queued': len(self._queues),
+            }
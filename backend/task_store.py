@@ -0,0 +1,125 @@
+import threading
+import time
+
+
+class StateSnapshot(dict):
+    """
+    Stato di un task in un certo istante, in sola lettura.
+
+    È un dict (serializzabile direttamente con jsonify) ma ogni modifica solleva
+    TypeError: uno snapshot pubblicato viene condiviso tra tutti i lettori.
+    """
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Task state snapshots are read-only, use the store's update()")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+
+class TaskState:
+    """
+    Stato di un singolo task.
+
+    I writer non modificano mai lo snapshot pubblicato: ne costruiscono uno nuovo
+    sotto il lock del task e lo pubblicano con un solo assegnamento di riferimento,
+    quindi i lettori (snapshot) non prendono lock e non vedono mai stati a metà.
+    version cresce a ogni scrittura. last_poll è tenuto fuori dallo snapshot:
+    lo aggiorna ogni polling di /status e non deve costare una copia.
+    """
+
+    __slots__ = ('snapshot', 'version', 'last_poll', '_lock')
+
+    def __init__(self, state):
+        state = dict(state)
+        # last_poll None = nessun polling ancora (es. task ripristinato dopo un riavvio)
+        self.last_poll = state.pop('last_poll') if 'last_poll' in state else time.time()
+        self.version = 1
+        self.snapshot = StateSnapshot(state, version=self.version)
+        self._lock = threading.Lock()
+
+    def publish(self, fields):
+        """Pubblica un nuovo snapshot con i campi aggiornati"""
+        with self._lock:
+            if self.snapshot.get('status') == 'cancelled':
+                # Un task annullato resta 'cancelled': la pipeline può scrivere ancora prima di fermarsi
+                fields = {key: value for key, value in fields.items() if key not in ('status', 'progress', 'message')}
+                if not fields:
+                    return
+            self.version += 1
+            self.snapshot = StateSnapshot(self.snapshot, **fields, version=self.version)
+
+
+class LocalTaskStore:
+    """
+    Stato dei task in memoria, per il ruolo API+worker nello stesso processo.
+
+    Stessa interfaccia di jobqueue.SQLiteJobQueue (create, get, update, touch,
+    remove, active, __len__), così app.py funziona uguale con la coda locale o condivisa.
+
+    Non c'è un lock globale: ogni task ha il proprio TaskState, le letture
+    restituiscono lo snapshot immutabile corrente e le scritture su task diversi
+    non si bloccano a vicenda.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    def create(self, task_id, state):
+        """Registra un nuovo task con lo stato iniziale"""
+        self._tasks[task_id] = TaskState(state)
+
+    def get(self, task_id):
+        """
+        Returns:
+            StateSnapshot | None: Stato del task (sola lettura), None se non esiste
+        """
+        record = self._tasks.get(task_id)
+        return record.snapshot if record is not None else None
+
+    def update(self, task_id, **fields):
+        """
+        Aggiorna i campi dello stato del task.
+
+        Returns:
+            bool: False se il task non esiste
+        """
+        record = self._tasks.get(task_id)
+        if record is None:
+            return False
+        if 'last_poll' in fields:
+            record.last_poll = fields.pop('last_poll')
+        if fields:
+            record.publish(fields)
+        return True
+
+    def touch(self, task_id):
+        """
+        Registra un polling di /status (usato dal watchdog dei task abbandonati).
+
+        Returns:
+            bool: False se il task non esiste
+        """
+        record = self._tasks.get(task_id)
+        if record is None:
+            return False
+        record.last_poll = time.time()
+        return True
+
+    def remove(self, task_id):
+        """Dimentica un task (es. risultato scaduto)"""
+        self._tasks.pop(task_id, None)
+
+    def active(self, statuses):
+        """
+        Returns:
+            list: (task_id, stato con last_poll) dei task con status in statuses
+        """
+        return [(task_id, dict(record.snapshot, last_poll=record.last_poll))
+                for task_id, record in list(self._tasks.items())
+                if record.snapshot.get('status') in statuses]
+
+    def __len__(self):
+        return len(self._tasks)
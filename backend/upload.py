@@ -0,0 +1,74 @@
+import os
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+
+# Dimensione dei blocchi letti dal body della richiesta
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadTooLarge(ValueError):
+    """Upload oltre il limite configurato (MAX_UPLOAD_BYTES)"""
+    pass
+
+
+class UploadStream:
+    """
+    Legge il body di un upload a blocchi, senza bufferizzarlo in memoria o su disco.
+
+    Supporta sia multipart/form-data (viene usato il primo campo file) sia un body
+    grezzo (application/octet-stream, audio/*, video/*, anche chunked). Iterando
+    l'oggetto si ottengono i byte del file, pronti per essere passati a ffmpeg.
+    """
+
+    def __init__(self, stream, mimetype, mimetype_params, max_bytes=None):
+        """
+        Args:
+            stream: Stream WSGI del body (request.stream)
+            mimetype: Content-Type della richiesta senza parametri
+            mimetype_params: Parametri del Content-Type (es. boundary)
+            max_bytes: Limite di byte letti dal body, None = nessun limite
+        """
+        self.stream = stream
+        self.mimetype = mimetype
+        self.boundary = mimetype_params.get('boundary')
+        self.max_bytes = max_bytes
+        self.filename = None
+        self.bytes_received = 0
+
+    def _read_body(self):
+        while True:
+            chunk = self.stream.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            self.bytes_received += len(chunk)
+            if self.max_bytes and self.bytes_received > self.max_bytes:
+                raise UploadTooLarge(f"Upload exceeds the maximum size of {self.max_bytes} bytes")
+            yield chunk
+
+    def __iter__(self):
+        if self.mimetype == 'multipart/form-data':
+            if not self.boundary:
+                raise ValueError("Missing multipart boundary")
+            return self._iter_multipart()
+        return self._read_body()
+
+    def _iter_multipart(self):
+        decoder = MultipartDecoder(self.boundary.encode('latin-1'))
+        # None = prima del file, True = dentro il primo file, False = file già letto
+        in_file = None
+        for chunk in self._read_body():
+            decoder.receive_data(chunk)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File) and in_file is None:
+                    in_file = True
+                    self.filename = os.path.basename(event.filename or '') or None
+                elif isinstance(event, (Field, File)) and in_file:
+                    in_file = False
+                elif isinstance(event, Data) and in_file:
+                    yield event.data
+                event = decoder.next_event()
+            if isinstance(event, Epilogue):
+                break
+        if in_file is None:
+            raise ValueError("No file found in multipart upload")
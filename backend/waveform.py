@@ -0,0 +1,265 @@
+import struct
+import numpy as np
+from scipy.signal import lfilter
+
+
+# Frequenza del PCM che ffmpeg scrive su stdout durante la conversione.
+# 22050 Hz è anche la frequenza che librosa usa per l'analisi BPM/tonalità (in mono).
+PCM_SAMPLE_RATE = 22050
+
+# Layout ammessi per il PCM: mono e stereo restano come sono (un mono portato a stereo
+# risulterebbe ~3 LU più forte), i formati multicanale vengono ridotti a stereo.
+# Il numero di canali effettivo arriva nell'header WAV dello stream.
+PCM_CHANNEL_LAYOUTS = 'mono|stereo'
+
+# Livelli di zoom del waveform: campioni per pixel
+PEAK_LEVELS = (256, 1024, 4096, 16384)
+
+# Formato del file .peaks (little endian):
+#   header:  magic 'YTPK', uint16 versione, uint16 numero livelli, uint32 sample rate
+#   livelli: uint32 campioni per pixel, uint32 numero pixel (uno per livello)
+#   dati:    per ogni livello, coppie int16 (min, max) scalate su [-32767, 32767]
+PEAKS_MAGIC = b'YTPK'
+PEAKS_VERSION = 1
+
+# Durata dell'audio passato all'analisi BPM/tonalità (come librosa.load(duration=30.0))
+ANALYSIS_SECONDS = 30.0
+
+
+def _k_weighting_filters(sample_rate):
+    """Coefficienti (b, a) dei due stadi del filtro K di ITU-R BS.1770 per la frequenza data"""
+    # Stadio 1: high shelf (+4 dB sopra ~1.5 kHz)
+    gain_db, q, fc = 4.0, 1 / np.sqrt(2), 1500.0
+    a_gain = 10 ** (gain_db / 40)
+    w0 = 2 * np.pi * fc / sample_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos_w0 = np.cos(w0)
+    shelf_b = [
+        a_gain * ((a_gain + 1) + (a_gain - 1) * cos_w0 + 2 * np.sqrt(a_gain) * alpha),
+        -2 * a_gain * ((a_gain - 1) + (a_gain + 1) * cos_w0),
+        a_gain * ((a_gain + 1) + (a_gain - 1) * cos_w0 - 2 * np.sqrt(a_gain) * alpha),
+    ]
+    shelf_a = [
+        (a_gain + 1) - (a_gain - 1) * cos_w0 + 2 * np.sqrt(a_gain) * alpha,
+        2 * ((a_gain - 1) - (a_gain + 1) * cos_w0),
+        (a_gain + 1) - (a_gain - 1) * cos_w0 - 2 * np.sqrt(a_gain) * alpha,
+    ]
+
+    # Stadio 2: high pass (~38 Hz)
+    q, fc = 0.5, 38.0
+    w0 = 2 * np.pi * fc / sample_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos_w0 = np.cos(w0)
+    highpass_b = [(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2]
+    highpass_a = [1 + alpha, -2 * cos_w0, 1 - alpha]
+
+    return [
+        (np.array(shelf_b) / shelf_a[0], np.array(shelf_a) / shelf_a[0]),
+        (np.array(highpass_b) / highpass_a[0], np.array(highpass_a) / highpass_a[0]),
+    ]
+
+
+class WaveformAnalyzer:
+    """
+    Analisi incrementale del PCM decodificato da ffmpeg durante la conversione.
+
+    In un solo passaggio sui dati (gli stessi che ffmpeg decodifica per l'encode)
+    calcola:
+    - picchi min/max a più livelli di zoom (PEAK_LEVELS)
+    - loudness integrata in LUFS (ITU-R BS.1770, con gating assoluto e relativo)
+    - i primi ANALYSIS_SECONDS secondi in mono, per l'analisi BPM/tonalità
+
+    Lo stream atteso è un WAV float32 little endian (come lo scrive ffmpeg su
+    una pipe, con dimensioni dei chunk non valorizzate), passato a blocchi
+    arbitrari con feed(). Frequenza e canali (1 o 2) vengono letti dall'header.
+    """
+
+    def __init__(self):
+        self.sample_rate = PCM_SAMPLE_RATE
+        self.channels = None
+        # Header WAV ancora da leggere (None una volta trovato il chunk 'data')
+        self._header = b''
+        self._remainder = b''
+
+        # Picchi del livello base (PEAK_LEVELS[0]); i livelli più larghi si ricavano in finalize()
+        self._peak_carry = np.zeros(0, dtype=np.float32)
+        self._peak_min = []
+        self._peak_max = []
+
+        # Loudness: potenza media per sotto-blocchi da 100 ms (filtri K preparati in _start)
+        self._power_carry = np.zeros(0)
+        self._subblock_power = []
+
+        # Inizio della traccia in mono per l'analisi BPM/tonalità
+        self._head = []
+        self._head_samples = 0
+
+    def _start(self, sample_rate, channels):
+        """Prepara l'analisi per il formato indicato nel chunk 'fmt ' dell'header"""
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._frame_bytes = 4 * channels
+        self._filters = _k_weighting_filters(sample_rate)
+        self._filter_state = [[np.zeros(2) for _ in self._filters] for _ in range(channels)]
+        self._subblock = int(round(0.1 * sample_rate))
+        self._head_limit = int(ANALYSIS_SECONDS * sample_rate)
+
+    def _parse_header(self):
+        """
+        Legge l'header WAV accumulato finora.
+
+        Returns:
+            bool: True quando è iniziato il chunk 'data' (i byte successivi sono PCM)
+        """
+        data = self._header
+        if len(data) < 12:
+            return False
+        if data[:4] not in (b'RIFF', b'RF64') or data[8:12] != b'WAVE':
+            raise ValueError("PCM stream is not a WAV stream")
+
+        offset = 12
+        while len(data) >= offset + 8:
+            chunk_id = data[offset:offset + 4]
+            size = struct.unpack('<I', data[offset + 4:offset + 8])[0]
+            body = offset + 8
+            if chunk_id == b'data':
+                # La dimensione del chunk dati non è nota su una pipe: si legge fino alla fine
+                if self.channels is None:
+                    raise ValueError("WAV stream without 'fmt ' chunk")
+                self._header = None
+                self._remainder = data[body:]
+                return True
+            if len(data) < body + size:
+                return False
+            if chunk_id == b'fmt ':
+                _, channels, sample_rate = struct.unpack('<HHI', data[body:body + 8])
+                bits = struct.unpack('<H', data[body + 14:body + 16])[0]
+                if bits != 32 or channels not in (1, 2):
+                    raise ValueError(f"Unsupported PCM stream: {channels} channels, {bits} bit")
+                self._start(sample_rate, channels)
+            offset = body + size + (size & 1)
+        return False
+
+    def feed(self, data):
+        """Aggiunge un blocco dello stream WAV (bytes, anche non allineato ai frame)"""
+        if self._header is not None:
+            self._header += data
+            if not self._parse_header():
+                return
+            data = b''
+        data = self._remainder + data
+        usable = len(data) - len(data) % self._frame_bytes
+        self._remainder = data[usable:]
+        if not usable:
+            return
+
+        frames = np.frombuffer(data[:usable], dtype='<f4').reshape(-1, self.channels)
+        mono = frames.mean(axis=1, dtype=np.float32)
+        self._feed_peaks(mono)
+        self._feed_loudness(frames)
+        if self._head_samples < self._head_limit:
+            head = mono[:self._head_limit - self._head_samples]
+            self._head.append(head)
+            self._head_samples += len(head)
+
+    def _feed_peaks(self, mono):
+        block = PEAK_LEVELS[0]
+        samples = np.concatenate((self._peak_carry, mono))
+        full = len(samples) - len(samples) % block
+        if full:
+            blocks = samples[:full].reshape(-1, block)
+            self._peak_min.append(blocks.min(axis=1))
+            self._peak_max.append(blocks.max(axis=1))
+        self._peak_carry = samples[full:]
+
+    def _feed_loudness(self, frames):
+        power = np.zeros(len(frames))
+        for channel in range(self.channels):
+            signal = frames[:, channel].astype(np.float64)
+            for stage, (b, a) in enumerate(self._filters):
+                signal, self._filter_state[channel][stage] = lfilter(
+                    b, a, signal, zi=self._filter_state[channel][stage]
+                )
+            power += signal * signal
+
+        samples = np.concatenate((self._power_carry, power))
+        full = len(samples) - len(samples) % self._subblock
+        if full:
+            self._subblock_power.append(samples[:full].reshape(-1, self._subblock).mean(axis=1))
+        self._power_carry = samples[full:]
+
+    def head(self):
+        """
+        Returns:
+            tuple: (y, sr) con i primi ANALYSIS_SECONDS secondi in mono float32
+        """
+        if not self._head:
+            return np.zeros(0, dtype=np.float32), self.sample_rate
+        return np.concatenate(self._head), self.sample_rate
+
+    def peak_levels(self):
+        """
+        Returns:
+            list: (campioni per pixel, array min, array max) per ogni livello di zoom
+        """
+        base_min = self._peak_min + ([np.array([self._peak_carry.min()])] if len(self._peak_carry) else [])
+        base_max = self._peak_max + ([np.array([self._peak_carry.max()])] if len(self._peak_carry) else [])
+        mins = np.concatenate(base_min) if base_min else np.zeros(0, dtype=np.float32)
+        maxs = np.concatenate(base_max) if base_max else np.zeros(0, dtype=np.float32)
+
+        levels = []
+        for samples_per_pixel in PEAK_LEVELS:
+            factor = samples_per_pixel // PEAK_LEVELS[0]
+            if factor > 1 and len(mins):
+                pad = (-len(mins)) % factor
+                level_min = np.pad(mins, (0, pad), mode='edge').reshape(-1, factor).min(axis=1)
+                level_max = np.pad(maxs, (0, pad), mode='edge').reshape(-1, factor).max(axis=1)
+            else:
+                level_min, level_max = mins, maxs
+            levels.append((samples_per_pixel, level_min, level_max))
+        return levels
+
+    def integrated_loudness(self):
+        """
+        Loudness integrata secondo ITU-R BS.1770 (blocchi da 400 ms con overlap 75%).
+
+        Misurata sul PCM a PCM_SAMPLE_RATE (22.05 kHz), non alla frequenza della
+        sorgente: il contenuto sopra 11 kHz non contribuisce, con scarti in genere
+        di pochi decimi di LU rispetto a una misura a piena banda.
+
+        Returns:
+            float | None: LUFS, None se l'audio è troppo corto o silenzioso
+        """
+        if not self._subblock_power:
+            return None
+        subblocks = np.concatenate(self._subblock_power)
+        if len(subblocks) < 4:
+            return None
+
+        # Blocco da 400 ms = media di 4 sotto-blocchi consecutivi da 100 ms
+        blocks = np.convolve(subblocks, np.ones(4) / 4, mode='valid')
+        with np.errstate(divide='ignore'):
+            loudness = -0.691 + 10 * np.log10(blocks)
+
+        gated = blocks[loudness > -70.0]
+        if not len(gated):
+            return None
+        relative_gate = -0.691 + 10 * np.log10(gated.mean()) - 10.0
+        gated = blocks[(loudness > -70.0) & (loudness > relative_gate)]
+        if not len(gated):
+            return None
+        return round(float(-0.691 + 10 * np.log10(gated.mean())), 1)
+
+    def write_peaks(self, path):
+        """Salva i picchi di tutti i livelli nel formato binario .peaks"""
+        levels = self.peak_levels()
+        with open(path, 'wb') as f:
+            f.write(PEAKS_MAGIC)
+            f.write(struct.pack('<HHI', PEAKS_VERSION, len(levels), self.sample_rate))
+            for samples_per_pixel, level_min, _ in levels:
+                f.write(struct.pack('<II', samples_per_pixel, len(level_min)))
+            for _, level_min, level_max in levels:
+                pairs = np.empty(len(level_min) * 2, dtype='<i2')
+                pairs[0::2] = np.clip(level_min, -1.0, 1.0) * 32767
+                pairs[1::2] = np.clip(level_max, -1.0, 1.0) * 32767
+                f.write(pairs.tobytes())
@@ -0,0 +1,189 @@
+"""
+Worker di conversione per la coda condivisa.
+
+Prende i job dalla coda SQLite (JOB_QUEUE_DB) riempita dal processo API e li
+esegue con la stessa pipeline di app.py. Se ne possono avviare quanti se ne
+vuole, sulla stessa macchina dell'API: il database SQLite (in modalità WAL) e
+OUTPUT_DIR devono stare su un disco locale, non su un filesystem di rete:
+
+    JOB_QUEUE_DB=/data/jobs.db OUTPUT_DIR=/data/output python -m worker
+"""
+import os
+import socket
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from converter import YouTubeAudioConverter, ConversionCancelled, LeaseLost, CancelEvent
+from jobqueue import SQLiteJobQueue
+from pipeline import run_conversion
+from retention import RESULT_RETENTION_SECONDS, RETENTION_CHECK_INTERVAL, purge_work_files
+
+
+# Durata del lease: se il worker non lo rinnova entro questo tempo il job torna in coda
+LEASE_SECONDS = int(os.environ.get('WORKER_LEASE_SECONDS', 60))
+
+# Attesa tra un controllo della coda e l'altro quando non c'è lavoro
+POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', 1.0))
+
+# Ogni quanto controllare gli annullamenti richiesti dall'API (molto più spesso del lease)
+CANCEL_POLL_INTERVAL = float(os.environ.get('WORKER_CANCEL_POLL_INTERVAL', 1.0))
+
+
+class Worker:
+    """Esegue i job della coda condivisa con N thread e rinnova i lease con heartbeat"""
+
+    def __init__(self, job_queue, converter, output_dir, concurrency):
+        """
+        Args:
+            job_queue: SQLiteJobQueue condivisa con il processo API
+            converter: YouTubeAudioConverter
+            output_dir: Directory dei file finali, servita da /download
+            concurrency: Job eseguiti in parallelo da questo processo
+        """
+        self.job_queue = job_queue
+        self.converter = converter
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        # task_id -> evento di annullamento dei job in esecuzione
+        self._running = {}
+        self._running_lock = threading.Lock()
+
+    def run(self):
+        """Avvia i thread di esecuzione e di heartbeat (blocca per sempre)"""
+        print(f"Worker {self.worker_id} started ({self.concurrency} slots, lease {LEASE_SECONDS}s)")
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._job_loop, name=f'worker-slot-{i}')
+            thread.daemon = True
+            thread.start()
+        self._heartbeat_loop()
+
+    def _job_loop(self):
+        while True:
+            try:
+                job = self.job_queue.claim(self.worker_id, LEASE_SECONDS)
+            except Exception as e:
+                print(f"⚠ Could not claim job: {e}")
+                job = None
+            if job is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            self._execute(*job)
+
+    def _execute(self, task_id, payload, state):
+        cancel_event = CancelEvent()
+        with self._running_lock:
+            self._running[task_id] = cancel_event
+
+        def report(**fields):
+            if not cancel_event.is_set():
+                self.job_queue.update(task_id, **fields)
+
+        try:
+            result = run_conversion(
+                self.converter, task_id, payload['url'], payload['format'],
+                output_dir=self.output_dir,
+                report=report,
+                # Le fasi completate restano fuori dallo stato di /status: servono solo a un
+                # altro worker per riprendere da lì
+                checkpoint=lambda event, **fields: self.job_queue.checkpoint(task_id, **fields),
+                cancel_event=cancel_event,
+                resume=state
+            )
+            self.job_queue.finish(task_id, self.worker_id, status='completed', progress=100,
+                                  message='Ready for download', **result)
+
+        except LeaseLost:
+            # Il job ora è di un altro worker: stato e file di lavoro sono suoi
+            pass
+
+        except ConversionCancelled:
+            # Annullato dall'utente: lo stato resta (o diventa) 'cancelled'
+            self.job_queue.finish(task_id, self.worker_id, status='cancelled')
+
+        except Exception as e:
+            error_msg = str(e)
+            print(f"Error during conversion: {error_msg}")
+            print(traceback.format_exc())
+            self.job_queue.finish(task_id, self.worker_id, status='error', progress=0,
+                                  message='Error during conversion', error=error_msg, file=None)
+
+        finally:
+            with self._running_lock:
+                self._running.pop(task_id, None)
+
+    def _heartbeat_loop(self):
+        """
+        Propaga gli annullamenti richiesti dall'API (ogni CANCEL_POLL_INTERVAL, con una
+        sola lettura) e rinnova i lease dei job in esecuzione (ogni LEASE_SECONDS / 3).
+        Ogni RETENTION_CHECK_INTERVAL rimuove i file di lavoro scaduti (RESULT_RETENTION_HOURS).
+        """
+        heartbeat_interval = max(1, LEASE_SECONDS // 3)
+        next_heartbeat = time.monotonic() + heartbeat_interval
+        next_purge = time.monotonic()
+        while True:
+            time.sleep(CANCEL_POLL_INTERVAL)
+            with self._running_lock:
+                running = list(self._running.items())
+            if RESULT_RETENTION_SECONDS > 0 and time.monotonic() >= next_purge:
+                next_purge = time.monotonic() + RETENTION_CHECK_INTERVAL
+                # I file dei job in esecuzione qui restano; quelli di altri worker sulla stessa
+                # WORK_DIR sono comunque più recenti della retention
+                purge_work_files(self.converter.temp_dir, RESULT_RETENTION_SECONDS,
+                                 {task_id for task_id, _ in running})
+            if not running:
+                continue
+            
+            try:
+                cancelled = self.job_queue.cancelled([task_id for task_id, _ in running])
+            except Exception as e:
+                print(f"⚠ Could not check cancellations: {e}")
+                cancelled = set()
+            for task_id, cancel_event in running:
+                if task_id in cancelled and not cancel_event.is_set():
+                    print(f"Task {task_id} stopped on this worker: cancelled")
+                    cancel_event.set()
+            
+            if time.monotonic() < next_heartbeat:
+                continue
+            next_heartbeat = time.monotonic() + heartbeat_interval
+            for task_id, cancel_event in running:
+                try:
+                    result = self.job_queue.heartbeat(task_id, self.worker_id, LEASE_SECONDS)
+                except Exception as e:
+                    print(f"⚠ Heartbeat failed for {task_id}: {e}")
+                    continue
+                if result == 'lost':
+                    # Il job è passato a un altro worker: ci si ferma senza toccare i suoi file
+                    print(f"Task {task_id} stopped on this worker: lease lost")
+                    cancel_event.hand_over()
+                elif result == 'cancelled':
+                    print(f"Task {task_id} stopped on this worker: cancelled")
+                    cancel_event.set()
+
+
+def main():
+    queue_path = os.environ.get('JOB_QUEUE_DB')
+    if not queue_path:
+        print("ERROR: JOB_QUEUE_DB is not set. Point it to the same SQLite file used by the API.")
+        exit(1)
+
+    work_dir = os.environ.get('WORK_DIR') or tempfile.gettempdir()
+    output_dir = os.environ.get('OUTPUT_DIR') or work_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    converter = YouTubeAudioConverter(work_dir)
+    print("Checking for ffmpeg...")
+    if not converter.check_ffmpeg():
+        print("ERROR: ffmpeg not found. Make sure it's installed on the system.")
+        exit(1)
+    print("✓ ffmpeg found")
+
+    concurrency = int(os.environ.get('MAX_CONCURRENT_JOBS', converter.cpu_budget.total))
+    Worker(SQLiteJobQueue(queue_path), converter, output_dir, concurrency).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,15 @@ const progressBar = document.getElementById('progressBar');
 const progressMessage = document.getElementById('progressMessage');
 const progressPercent = document.getElementById('progressPercent');
 
+// Task in corso (annullato sul server se l'utente chiude la pagina)
+let activeTaskId = null;
+
+window.addEventListener('pagehide', () => {
+    if (activeTaskId) {
+        fetch(`${API_URL}/task/${activeTaskId}`, { method: 'DELETE', keepalive: true });
+    }
+});
+
 // Nasconde i messaggi
 function hideMessages() {
     errorMessage.style.display = 'none';
@@ -205,6 +214,7 @@ form.addEventListener('submit', async (e) => {
         }
         
         console.log('Task ID received:', taskId);
+        activeTaskId = taskId;
         console.log('Starting status polling in 500ms...');
         
         // Piccolo delay prima di iniziare il polling per evitare race condition
@@ -241,6 +251,13 @@ form.addEventListener('submit', async (e) => {
                     // Reset contatore se non è 404
                     notFoundCount = 0;
                     
+                    // Server in riavvio (proxy senza backend): il task viene ripristinato, continua a riprovare
+                    if ([502, 503, 504].includes(statusResponse.status)) {
+                        console.warn(`Server unavailable (${statusResponse.status}), retrying...`);
+                        progressMessage.textContent = 'Server restarting, reconnecting... 🔄';
+                        return;
+                    }
+                    
                     clearInterval(pollInterval);
                     let errorMsg = 'Server communication issue';
                     try {
@@ -265,6 +282,10 @@ form.addEventListener('submit', async (e) => {
                 // Aggiorna progress bar e messaggio
                 updateProgress(status.progress, status.message);
                 
+                if (['completed', 'error', 'cancelled'].includes(status.status)) {
+                    activeTaskId = null;
+                }
+                
                 if (status.status === 'completed') {
                     clearInterval(pollInterval);
                     
@@ -304,14 +325,18 @@ form.addEventListener('submit', async (e) => {
                     showError(errorMsg.includes('playlist') ? 'No playlists, single videos only! 🙄' : `😬 ${errorMsg}`);
                     setLoading(false);
                     hideProgress();
+                } else if (status.status === 'cancelled') {
+                    clearInterval(pollInterval);
+                    showError('Conversion cancelled 🛑');
+                    setLoading(false);
+                    hideProgress();
                 }
                 
             } catch (error) {
-                console.error('Polling error:', error);
-                clearInterval(pollInterval);
-                showError('Server not responding, make sure it\'s running! 🤷');
-                setLoading(false);
-                hideProgress();
+                // Errore di rete (es. server in riavvio): il job riprende dal journal,
+                // quindi si continua a fare polling invece di abbandonare il task
+                console.error('Polling error, retrying:', error);
+                progressMessage.textContent = 'Server not responding, reconnecting... 🔄';
             }
         }, 500); // Poll ogni 500ms
         